@@ -0,0 +1,139 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    call an AWS API directly with boto3 for each account and region (--api) rather
+    than running a command in a child process
+"""
+
+import json
+import datetime
+import boto3
+import botocore
+import botocore.config
+from . import utils, commands, credentials, trace, cli, capture
+
+# the exit code the AWS CLI uses when an API call fails...
+API_ERROR_RETURNCODE = 255
+
+
+def parse_api(options):
+    """ split --api SERVICE:OPERATION into a service name and a boto3 method name """
+    service, operation = options.api.split(":", 1)
+    if "-" in operation:
+        method = operation.replace("-", "_")
+    else:
+        method = botocore.xform_name(operation)
+    return (service, method)
+
+
+def parse_params(options):
+    """ turn --param KEY=VALUE options into API parameters, VALUE may be JSON """
+    params = {}
+    for param in options.params or []:
+        key, value = param.split("=", 1)
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def create_client(logger, options, command_list, service):
+    """ create a boto3 client for a command's account and region from the shared session, so
+        that service models are only loaded once rather than once per client, each target has
+        credentials of its own so a client is only used (and kept) for one command """
+    env = command_list["environment"]
+    logger.debug("Creating %s client for: %s in %s", service, command_list["account_id"],
+                 command_list["region"])
+    region = None if command_list["region"] == "<default>" else command_list["region"]
+    # there is no child process to stop, so --timeout applies to each request...
+    config = None
+    if options.timeout:
+        config = botocore.config.Config(connect_timeout=options.timeout,
+                                        read_timeout=options.timeout)
+    return trace.trace_client(utils.GLOBALS["api_session"].client(
+        service, region_name=region, config=config,
+        aws_access_key_id=env.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=env.get("AWS_SECRET_ACCESS_KEY"),
+        aws_session_token=env.get("AWS_SESSION_TOKEN")))
+
+
+def format_value(value):
+    """ make API responses JSON friendly in the same way the AWS CLI does """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return format(value)
+
+
+def call_api(client, method, params):
+    """ make the API call, following all of the pages of results if the API is paged, the
+        result is captured as JSON in the same way as the output of an AWS CLI command """
+    if client.can_paginate(method):
+        result = client.get_paginator(method).paginate(**params).build_full_result()
+    else:
+        result = getattr(client, method)(**params)
+    result.pop("ResponseMetadata", None)
+    buffer = capture.Buffer()
+    buffer.write(json.dumps(result, default=format_value).encode("ascii"))
+    return buffer.finish()
+
+
+def start_clients(logger, options, commands_list):
+    """ set up the shared session, then check the --api operation exists using a client for
+        the first command, which also loads the service model before any threads share the
+        session """
+    utils.GLOBALS["api_session"] = boto3.session.Session()
+    if not commands_list:
+        return
+
+    service, method = parse_api(options)
+    try:
+        client = create_client(logger, options, commands_list[0], service)
+    except botocore.exceptions.UnknownServiceError:
+        cli.error("error: unknown --api service: {}".format(service))
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+        # anything else is reported against each command as it runs...
+        return
+    if method not in [botocore.xform_name(x) for x in client.meta.service_model.operation_names]:
+        cli.error("error: unknown --api operation for {}: {}".format(
+            service, options.api.split(":", 1)[1]))
+
+
+def run_command_unsafe(logger, options, command_list):
+    """ make an API call, output is recorded exactly as commands.run_command_unsafe
+        records the output of a command """
+
+    if commands.get_stop_reason():
+        return
+
+    credentials.refresh_command_credentials(logger, options, command_list)
+    output = commands.create_command_output(command_list)
+    service, method = parse_api(options)
+
+    try:
+        client = create_client(logger, options, command_list, service)
+        commands.set_command_output(command_list, output,
+                                    call_api(client, method, parse_params(options)))
+
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        if commands.should_retry_expired(logger, options, command_list, format(be_err)):
+            run_command_unsafe(logger, options, command_list)
+            return
+        logger.info("API call failed")
+        commands.set_command_error(command_list, output, format(be_err), format(be_err),
+                                   API_ERROR_RETURNCODE)
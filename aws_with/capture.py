@@ -0,0 +1,176 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    buffers for command output that keep small outputs in memory and spill large
+    outputs (and everything once MEMORY_LIMIT is used up) to temporary files until
+    they are needed
+"""
+
+import os
+import codecs
+import atexit
+import shutil
+import locale
+import tempfile
+import threading
+
+# outputs bigger than this are kept on disk rather than in memory...
+SPILL_SIZE = 1024 * 1024
+
+# ...and once the outputs kept in memory add up to this, the rest are kept on disk too...
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+MEMORY = {"used":0}
+MEMORY_LOCK = threading.Lock()
+
+READ_SIZE = 65536
+
+SPILL_DIR = {}
+SPILL_DIR_LOCK = threading.Lock()
+
+
+def get_spill_dir():
+    """ get the private directory spilled outputs are written to, it is removed at exit """
+    with SPILL_DIR_LOCK:
+        if "path" not in SPILL_DIR:
+            SPILL_DIR["path"] = tempfile.mkdtemp(prefix="aws_with-")
+            atexit.register(shutil.rmtree, SPILL_DIR["path"], True)
+        return SPILL_DIR["path"]
+
+
+def reserve_memory(size):
+    """ claim size bytes of MEMORY_LIMIT for an output, returns False if there isn't room """
+    with MEMORY_LOCK:
+        if MEMORY["used"] + size > MEMORY_LIMIT:
+            return False
+        MEMORY["used"] += size
+        return True
+
+
+def release_memory(size):
+    """ give back bytes claimed with reserve_memory() """
+    with MEMORY_LOCK:
+        MEMORY["used"] -= size
+
+
+def decode(data):
+    """ decode output in the same way as subprocess does with universal_newlines, except that
+        bytes which aren't valid in the encoding are replaced rather than raising an error """
+    text = data.decode(locale.getpreferredencoding(False), "replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class Buffer(object):
+    """ the output of one stream of a command, in memory or spilled to a file """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.memory = 0
+        self.path = None
+        self.file = None
+
+    def open_file(self):
+        """ spill straight away and return the file, so a child process can write to it """
+        handle, self.path = tempfile.mkstemp(dir=get_spill_dir())
+        self.file = os.fdopen(handle, "w+b")
+        for chunk in self.chunks:
+            self.file.write(chunk)
+        self.chunks = []
+        release_memory(self.memory)
+        self.memory = 0
+        return self.file
+
+    def write(self, data):
+        """ add some output, spilling to a file once it gets too big or memory runs out """
+        self.size += len(data)
+        if self.file is None and (self.size > SPILL_SIZE or not reserve_memory(len(data))):
+            self.open_file()
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.chunks.append(data)
+            self.memory += len(data)
+
+    def finish(self):
+        """ no more output is coming, bring small outputs back into memory if there's room """
+        if self.file is None:
+            return self
+        self.file.flush()
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.file.close()
+        self.file = None
+        if self.size <= SPILL_SIZE and reserve_memory(self.size):
+            with open(self.path, "rb") as spilled:
+                self.chunks = [spilled.read()]
+            self.memory = self.size
+            os.remove(self.path)
+            self.path = None
+        return self
+
+    def getvalue(self):
+        """ all of the output as bytes """
+        if self.path is None:
+            return b"".join(self.chunks)
+        with open(self.path, "rb") as spilled:
+            return spilled.read()
+
+    def text(self):
+        """ all of the output as text """
+        return decode(self.getvalue())
+
+    def iter_text(self):
+        """ the output as a series of pieces of text, without reading it all into memory """
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))("replace")
+        if self.path is None:
+            for chunk in self.chunks:
+                yield decoder.decode(chunk)
+        else:
+            with open(self.path, "rb") as spilled:
+                for chunk in iter(lambda: spilled.read(READ_SIZE), b""):
+                    yield decoder.decode(chunk)
+        yield decoder.decode(b"", True)
+
+    def ends(self):
+        """ the first and last characters of the output, ignoring whitespace """
+        if self.path is None:
+            head = tail = b"".join(self.chunks)
+        else:
+            with open(self.path, "rb") as spilled:
+                head = spilled.read(READ_SIZE)
+                spilled.seek(max(0, self.size - READ_SIZE))
+                tail = spilled.read()
+        head = head.lstrip()
+        tail = tail.rstrip()
+        return (head[:1], tail[-1:])
+
+    def close(self):
+        """ throw the output away """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            # the file may already have been removed by a copy of this buffer in a worker...
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self.chunks = []
+        release_memory(self.memory)
+        self.memory = 0
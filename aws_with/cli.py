@@ -17,6 +17,7 @@ specific language governing permissions and limitations
 under the License.
 """
 
+import os
 import sys
 import argparse
 from . import utils
@@ -78,14 +79,152 @@ EXAMPLES:
                         dest="no_recursive", action="store_true",
                         help="When scanning Organizations for accounts, don't look recursively")
 
+    parser.add_argument("--cache-credentials",
+                        dest="cache_credentials", action="store_true",
+                        help="Cache assumed role credentials on disk (readable only by the "
+                             "current user) and reuse them until they are close to expiry")
+
+    parser.add_argument("--org-cache-ttl",
+                        dest="org_cache_ttl", action="store", default=0, type=int,
+                        metavar="SECONDS",
+                        help="Keep a snapshot of the Organizations tree on disk and use it "
+                             "for -o until it is SECONDS old (default: 0, no snapshot)")
+
+    parser.add_argument("--refresh-org",
+                        dest="refresh_org", action="store_true",
+                        help="Rebuild the Organizations snapshot used by --org-cache-ttl")
+
+    parser.add_argument("--region-cache-ttl",
+                        dest="region_cache_ttl", action="store", default=86400, type=int,
+                        metavar="SECONDS",
+                        help="Cache the list of AWS regions used by -R on disk for SECONDS "
+                             "(default: 86400, 0 to disable)")
+
+    parser.add_argument("--enabled-regions-only",
+                        dest="enabled_regions_only", action="store_true",
+                        help="Check which regions are enabled in each account and skip "
+                             "running the command in any that are not")
+
     parser.add_argument("-t", "--threads",
                         dest="threads", action="store", default=2, type=int,
                         help="Set the number of threads to use when running commands (default: 2)")
 
+    parser.add_argument("--max-per-region",
+                        dest="max_per_region", action="store", type=int, metavar="N",
+                        help="Run no more than N commands at once in any one region")
+
+    parser.add_argument("--max-per-account",
+                        dest="max_per_account", action="store", type=int, metavar="N",
+                        help="Run no more than N commands at once in any one account")
+
+    parser.add_argument("--max-per-target",
+                        dest="max_per_target", action="store", type=int, metavar="N",
+                        help="Run no more than N commands at once in any one account and "
+                             "region")
+
+    parser.add_argument("--adaptive",
+                        dest="adaptive", action="store_true",
+                        help="Halve the number of commands that can run at once in a region, "
+                             "account and account/region when a command there is throttled, "
+                             "then slowly raise it again as commands succeed")
+
+    parser.add_argument("--retries",
+                        dest="retries", action="store", default=0, type=int, metavar="N",
+                        help="Run a command up to N more times if it fails because it was "
+                             "throttled or had a transient network error, waiting a random "
+                             "and increasing time between attempts")
+
+    parser.add_argument("--timeout",
+                        dest="timeout", action="store", type=float, metavar="SECONDS",
+                        help="Stop a command (and everything it started) that runs for longer "
+                             "than this, it is reported as an error")
+
+    parser.add_argument("--deadline",
+                        dest="deadline", action="store", type=float, metavar="SECONDS",
+                        help="Stop all commands that are still running this long after they "
+                             "started to run, commands that haven't started are reported as "
+                             "errors")
+
+    parser.add_argument("--longest-first",
+                        dest="longest_first", action="store_true",
+                        help="Start the commands that are expected to take longest first, "
+                             "based on how long each account and region took to run the same "
+                             "command before (durations are kept in the cache directory)")
+
+    parser.add_argument("--hedge",
+                        dest="hedge", action="store_true",
+                        help="Start a second attempt at a command that is taking much longer "
+                             "than the others, keeping whichever attempt finishes first (only "
+                             "use this for commands that are safe to run twice)")
+
+    parser.add_argument("--hedge-percentile",
+                        dest="hedge_percentile", action="store", default=95.0, type=float,
+                        metavar="PERCENT",
+                        help="With --hedge, a command is slow if it has been running for "
+                             "longer than this percentile of the commands that have finished "
+                             "(default 95)")
+
+    parser.add_argument("--hedge-limit",
+                        dest="hedge_limit", action="store", default=0.1, type=float,
+                        metavar="FRACTION",
+                        help="With --hedge, no more than this fraction of --threads (rounded "
+                             "down) are used for second attempts (default 0.1)")
+
+    parser.add_argument("--trace",
+                        dest="trace", action="store", metavar="FILE",
+                        help="Write the time spent in each phase, AWS API call and command to "
+                             "FILE in the Chrome trace event format, with a summary on -v")
+
+    parser.add_argument("--metrics-file",
+                        dest="metrics_file", action="store", metavar="FILE",
+                        help="Write metrics about the run (targets, phase durations, command "
+                             "durations by region, API calls, throttling and concurrency) to "
+                             "FILE in the OpenMetrics text format, e.g. for the node exporter "
+                             "textfile collector")
+
+    parser.add_argument("--metrics-interval",
+                        dest="metrics_interval", action="store", type=float, metavar="SECONDS",
+                        help="With --metrics-file, also rewrite FILE this often while the run "
+                             "is going, not only when it ends")
+
+    parser.add_argument("--engine",
+                        dest="engine", action="store", default="threads",
+                        type=str, choices=["threads", "events"],
+                        help="Run commands with a thread per command, or supervise them all "
+                             "from a single event loop which allows much larger values of "
+                             "--threads (default: threads)")
+
+    parser.add_argument("--preload-cli",
+                        dest="preload_cli", action="store_true",
+                        help="Run AWS CLI commands in a pool of worker processes that have "
+                             "already loaded the AWS CLI instead of starting `aws` for "
+                             "every account and region")
+
+    parser.add_argument("--api",
+                        dest="api", action="store", metavar="SERVICE:OPERATION",
+                        help="Instead of running a command, call the API OPERATION of SERVICE "
+                             "with boto3, e.g. --api ec2:DescribeInstances")
+
+    parser.add_argument("--param",
+                        dest="params", action="append", metavar="KEY=VALUE",
+                        help="Pass the parameter KEY to the --api call, VALUE may be JSON.  "
+                             "This option may be given multiple times")
+
     parser.add_argument("-f", "--output",
                         dest="format", action="store", default="json",
-                        type=str, choices=["json", "yaml", "text"],
-                        help="Set the output format to use")
+                        type=str, choices=["json", "yaml", "text", "ndjson"],
+                        help="Set the output format to use, ndjson writes each command's "
+                             "output as a line of JSON as soon as the command finishes")
+
+    parser.add_argument("--no-passthrough",
+                        dest="no_passthrough", action="store_true",
+                        help="Always parse and reformat AWS CLI JSON output, rather than "
+                             "copying it into the JSON output as it is")
+
+    parser.add_argument("--parallel-output",
+                        dest="parallel_output", action="store_true",
+                        help="Parse and format command outputs across a pool of processes, "
+                             "one per CPU, which helps when outputs are very large")
 
     parser.add_argument("-q", "--quiet",
                         dest="quiet", action="store_true",
@@ -120,7 +259,6 @@ EXAMPLES:
 
 def show_version():
     """ display version information and then exit """
-    import os
     import inspect
     import awscli
     import boto3
@@ -154,6 +292,54 @@ def args_basic_checks(parsed_options):
     if parsed_options.threads < 1:
         parsed_options.threads = 1
 
+    for limit in [parsed_options.max_per_region, parsed_options.max_per_account,
+                  parsed_options.max_per_target]:
+        if limit is not None and limit < 1:
+            error("error: --max-per-region, --max-per-account and --max-per-target "
+                  "must be at least 1")
+
+    if parsed_options.retries < 0:
+        error("error: --retries must not be negative")
+
+    for limit in [parsed_options.timeout, parsed_options.deadline]:
+        if limit is not None and limit <= 0:
+            error("error: --timeout and --deadline must be more than 0")
+
+    if not 0 < parsed_options.hedge_percentile < 100 or not 0 < parsed_options.hedge_limit <= 1:
+        error("error: --hedge-percentile must be between 0 and 100 and --hedge-limit must be "
+              "more than 0 and no more than 1")
+
+    if parsed_options.metrics_interval is not None and (parsed_options.metrics_interval <= 0 or
+                                                        not parsed_options.metrics_file):
+        error("error: --metrics-interval must be more than 0 and needs --metrics-file")
+
+    if parsed_options.engine == "events" and (os.name != "posix" or sys.version_info < (3, 4)):
+        error("error: --engine=events needs Python 3.4 or later on a POSIX system")
+
+    if parsed_options.preload_cli and sys.version_info < (3, 4):
+        error("error: --preload-cli needs Python 3.4 or later")
+
+    if parsed_options.api and parsed_options.command:
+        error("error: you cannot specify both --api and a command to run")
+
+    if parsed_options.api and ":" not in parsed_options.api:
+        error("error: --api must be given as SERVICE:OPERATION")
+
+    if parsed_options.params and not parsed_options.api:
+        error("error: --param can only be used with --api")
+
+    if parsed_options.params and [x for x in parsed_options.params if "=" not in x]:
+        error("error: --param must be given as KEY=VALUE")
+
+    if parsed_options.api and (parsed_options.engine == "events" or parsed_options.preload_cli):
+        error("error: you cannot specify --api with --engine=events or --preload-cli")
+
+    if parsed_options.engine == "events" and parsed_options.preload_cli:
+        error("error: you cannot specify both --engine=events and --preload-cli")
+
+    if parsed_options.hedge and (parsed_options.api or parsed_options.preload_cli):
+        error("error: you cannot specify --hedge with --api or --preload-cli")
+
     check_none = [parsed_options.role, parsed_options.regions,
                   parsed_options.ous, parsed_options.accounts]
 
@@ -188,4 +374,8 @@ def check_args():
     parsed_options.ous = sorted(set(utils.split_list(parsed_options.ous, ",")))
     parsed_options.accounts = sorted(set(utils.split_list(parsed_options.accounts, ",")))
     parsed_options.regions = sorted(set(utils.split_list(parsed_options.regions, ",")))
+
+    # an API call is shown in the output as if it were a command...
+    if parsed_options.api:
+        parsed_options.command = ["api", parsed_options.api] + (parsed_options.params or [])
     return parsed_options
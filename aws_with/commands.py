@@ -18,49 +18,89 @@ under the License.
 """
 
 import os
+import sys
+import time
+import signal
+import threading
 import subprocess
-import json
 import copy
-from . import utils, monkey
+from . import utils, monkey, credentials, capture
+
+# commands that are stopped get this many seconds to exit before they are killed...
+KILL_GRACE_PERIOD = 5
+
+# how often a worker checks if its command has been stopped by another thread...
+STOP_POLL_INTERVAL = 1
 
 
 monkey.apply_patches()
 
 
-def run_command(logger, options, command_list):
-    """ safe version for run_command_unsafe that takes care of locks """
-    try:
-        logger.debug("calling run_command_unsafe...")
-        run_command_unsafe(logger, options, command_list)
-    finally:
-        utils.GLOBALS["thread_count"] = utils.GLOBALS["thread_count"] - 1
-        logger.debug("commands still remaining: %s", utils.GLOBALS["thread_count"])
-        if utils.GLOBALS["thread_count"] == 0:
-            utils.GLOBALS["main_thread_lock"].release()
-        logger.debug("thread is finished, releasing lock")
-        utils.GLOBALS["thread_pool_lock"].release()
+def is_expired_token_error(output):
+    """ check if a command failed because its session token had expired """
+    return output is not None and ("ExpiredToken" in output or "RequestExpired" in output)
 
 
-def run_command_unsafe(logger, options, command_list):
-    """ run a command """
+THROTTLING_ERRORS = ["Throttling", "ThrottlingException", "RequestLimitExceeded",
+                     "TooManyRequestsException", "SlowDown", "Rate exceeded"]
 
-    if utils.GLOBALS["stop_because_of_error"]:
-        return
+TRANSIENT_ERRORS = ["Could not connect to the endpoint URL", "Connection was closed",
+                    "Connection reset by peer", "Read timeout on endpoint",
+                    "Connect timeout on endpoint", "EndpointConnectionError",
+                    "RequestTimeout", "ServiceUnavailable", "InternalError", "InternalFailure"]
+
+
+def get_error_texts(output):
+    """ the error message and output of a failed command, for looking for known errors """
+    texts = [output["error"]["message"]]
+    for key in ["output", "stderr"]:
+        if isinstance(output.get(key), capture.Buffer):
+            # stdout could be huge, and the AWS CLI reports errors on stderr anyway...
+            if key == "stderr" or output[key].size <= capture.READ_SIZE:
+                texts.append(output[key].text())
+        elif output.get(key):
+            texts.append(format(output[key]))
+    return texts
 
+
+def is_throttled(output):
+    """ check if a failed command's output (or error) shows it was throttled by AWS """
+    if "error" not in output:
+        return False
+    texts = get_error_texts(output)
+    return any(error in text for error in THROTTLING_ERRORS for text in texts)
+
+
+def is_retryable(output):
+    """ check if a failed command failed because of throttling or a transient error """
+    if "error" not in output:
+        return False
+    texts = get_error_texts(output)
+    return any(error in text for error in THROTTLING_ERRORS + TRANSIENT_ERRORS
+               for text in texts)
+
+
+def should_retry_expired(logger, options, command_list, output):
+    """ check if a failed command should be run again with refreshed credentials,
+        this is only tried once per command """
+    if is_expired_token_error(output) and "expired_retry" not in command_list and \
+            credentials.refresh_command_credentials(logger, options, command_list, True):
+        logger.info("Command failed with expired credentials, running it again")
+        command_list["expired_retry"] = True
+        return True
+    return False
+
+
+def get_command_environment(command_list):
+    """ the environment to run a command with """
     env = copy.deepcopy(os.environ)
     env.update(command_list["environment"])
-    output = {}
+    return env
 
-    # check if this is a single command to run a SHELL...
-    if not command_list["command"]:
-        logger.debug("launching shell: %s", os.environ["SHELL"])
-        command_list["command"] = os.environ["SHELL"]
-        prompt = "[\\u({}:{})@\\h \\W]\\$ "
-        env["PS1"] = prompt.format(command_list["account"], command_list["role"])
-        subprocess.call(command_list["command"], env=env)
-        return
 
-    # copy some details from the command request to the command output...
+def create_command_output(command_list):
+    """ copy some details from the command request to the command output... """
+    output = {}
     if isinstance(command_list["account"], dict):
         output["account"] = command_list["account"]["Id"]
         output["path"] = command_list["account"]["Path"]
@@ -70,35 +110,223 @@ def run_command_unsafe(logger, options, command_list):
     output["role"] = command_list["role"]
     output["region"] = command_list["region"]
     output["command"] = " ".join(command_list["command"])
+    return output
+
+
+def get_stop_reason():
+    """ the reason running commands should be stopped and no more started, if there is one """
+    if utils.GLOBALS.get("deadline_reached"):
+        return "deadline"
+    if utils.GLOBALS["stop_because_of_error"]:
+        return "stopped"
+    return None
+
+
+def get_popen_options():
+    """ start each command in a process group of its own, so that it can be stopped along
+        with everything it started """
+    if os.name != "posix":
+        return {}
+    if sys.version_info >= (3, 2):
+        return {"start_new_session": True}
+    return {"preexec_fn": os.setsid}
+
+
+def signal_process(process, sig):
+    """ send a signal to a command's process group, or just to the process if it hasn't got one """
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, sig)
+        elif sig == signal.SIGTERM:
+            process.terminate()
+        else:
+            process.kill()
+    except OSError:
+        # everything has already exited...
+        pass
+
+
+def stop_process(logger, command_list, reason):
+    """ ask a running command to stop (SIGTERM), and kill it (SIGKILL) if it is still running
+        after KILL_GRACE_PERIOD seconds, the reason is recorded against the command """
+    process = command_list.get("process")
+    if process is None or process.returncode is not None or "killed" in command_list:
+        return
+    command_list["stopped_at"] = time.time()
+    command_list["killed"] = reason
+    logger.info("Stopping command (%s): %s", reason, " ".join(command_list["command"]))
+    signal_process(process, signal.SIGTERM)
+    # the engines kill their own commands once the grace period is up, except on python 2...
+    if "supervised" in command_list:
+        return
+    timer = threading.Timer(KILL_GRACE_PERIOD, signal_process,
+                            (process, getattr(signal, "SIGKILL", signal.SIGTERM)))
+    timer.daemon = True
+    timer.start()
+
 
-    # run the command and capture the output...
+def is_stopped(command_list, returncode):
+    """ check if a command that was asked to stop was ended by that rather than exiting by
+        itself first, in which case its own result is kept, a command that was stopped because
+        it ran past its timeout or the deadline counts as stopped however it exited """
+    reason = command_list.get("killed")
+    if reason is None:
+        return False
+    if reason in ["timeout", "deadline"] or os.name != "posix" or \
+            (returncode is not None and returncode < 0):
+        return True
+    del command_list["killed"]
+    return False
+
+
+def wait_process_with_timers(logger, options, command_list, process):
+    """ wait for a command to exit, stopping it from a timer thread if it runs past --timeout,
+        for python 2 where process.wait() can't time out """
+    timer = None
+    if options.timeout:
+        timer = threading.Timer(options.timeout, stop_process, (logger, command_list, "timeout"))
+        timer.daemon = True
+        timer.start()
     try:
-        output["output"] = subprocess.check_output(command_list["command"],
-                                                   env=env, stderr=subprocess.STDOUT,
-                                                   shell=False, universal_newlines=True)
-        # try and parse the command output as JSON...
+        return process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+def wait_process(logger, options, command_list, process):
+    """ wait for a command to exit, stopping it if it runs past --timeout and killing it if it
+        is still running KILL_GRACE_PERIOD seconds after being stopped (here or by another
+        thread), all from the worker thread rather than starting timer threads """
+    if sys.version_info < (3, 3):
+        return wait_process_with_timers(logger, options, command_list, process)
+    timeout_at = time.time() + options.timeout if options.timeout else None
+    # only wake up to check on the command if something else might stop it...
+    may_be_stopped = options.stop_on_error or options.hedge or \
+        utils.GLOBALS.get("deadline") is not None
+    killed = False
+    while True:
+        now = time.time()
+        due = []
+        if "killed" in command_list:
+            if not killed and command_list["stopped_at"] + KILL_GRACE_PERIOD <= now:
+                signal_process(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+                killed = True
+            elif not killed:
+                due.append(command_list["stopped_at"] + KILL_GRACE_PERIOD)
+        else:
+            if timeout_at is not None and timeout_at <= now:
+                stop_process(logger, command_list, "timeout")
+                continue
+            if timeout_at is not None:
+                due.append(timeout_at)
+            if may_be_stopped:
+                due.append(now + STOP_POLL_INTERVAL)
         try:
-            output["output"] = json.loads(output["output"])
-        except (ValueError, SyntaxError):
+            return process.wait(min(due) - now if due else None)
+        except subprocess.TimeoutExpired:
             pass
 
-        command_list["output"] = output
 
-    except subprocess.CalledProcessError as cpe:
-        logger.info("Command returned non-zero exit code")
-        output["error"] = {}
-        output["error"]["message"] = format(cpe)
-        output["output"] = cpe.output
-        output["error"]["returncode"] = cpe.returncode
-        command_list["output"] = output
-        if options.stop_on_error:
-            utils.GLOBALS["stop_because_of_error"] = True
+def set_command_output(command_list, output, stdout, stderr=None):
+    """ record the output of a command that was successful, it is parsed when it is printed """
+    output["output"] = stdout
+    if stderr is not None:
+        output["stderr"] = stderr
+    command_list["output"] = output
+
+
+def set_command_error(command_list, output, stdout, message, returncode=None, stderr=None):
+    """ record the output of a command that failed """
+    output["error"] = {}
+    output["error"]["message"] = message
+    output["output"] = stdout
+    if stderr is not None:
+        output["stderr"] = stderr
+    if returncode is not None:
+        output["error"]["returncode"] = returncode
+    command_list["output"] = output
+
+
+def set_command_stopped(options, command_list, output, stdout, reason, returncode=None,
+                        stderr=None):
+    """ record the output of a command that was stopped before it finished """
+    if reason == "timeout":
+        message = "Command timed out after {:g} seconds".format(options.timeout)
+    elif reason == "deadline":
+        message = "Command was still running when the deadline for the run was reached"
+    elif reason == "hedged":
+        message = "Command was stopped because another attempt at it finished first"
+    else:
+        message = "Command was stopped because another command failed"
+    set_command_error(command_list, output, stdout, message, returncode, stderr)
+    output["error"]["reason"] = reason
+
+
+def run_command_unsafe(logger, options, command_list):
+    """ run a command """
+
+    if get_stop_reason():
+        return
+
+    # long runs can outlive the credentials assumed when the work plan was built...
+    credentials.refresh_command_credentials(logger, options, command_list)
+
+    env = get_command_environment(command_list)
+
+    # check if this is a single command to run a SHELL...
+    if not command_list["command"]:
+        logger.debug("launching shell: %s", os.environ["SHELL"])
+        command_list["command"] = os.environ["SHELL"]
+        prompt = "[\\u({}:{})@\\h \\W]\\$ "
+        env["PS1"] = prompt.format(command_list["account"], command_list["role"])
+        subprocess.call(command_list["command"], env=env)
+        return
+
+    output = create_command_output(command_list)
+
+    # run the command, capturing stdout and stderr separately into files so that large
+    # outputs don't have to be held in memory...
+    stdout = capture.Buffer()
+    stderr = capture.Buffer()
+    try:
+        process = subprocess.Popen(command_list["command"], env=env, shell=False,
+                                   stdout=stdout.open_file(), stderr=stderr.open_file(),
+                                   **get_popen_options())
+        command_list["process"] = process
+        if sys.version_info >= (3, 3):
+            command_list["supervised"] = True
+        if get_stop_reason():
+            stop_process(logger, command_list, get_stop_reason())
+        returncode = wait_process(logger, options, command_list, process)
 
     except OSError as ose:
         logger.info("Command failed to start")
-        output["output"] = ""
-        output["error"] = {}
-        output["error"]["message"] = format(ose)
-        command_list["output"] = output
-        if options.stop_on_error:
-            utils.GLOBALS["stop_because_of_error"] = True
+        stdout.close()
+        stderr.close()
+        set_command_error(command_list, output, "", format(ose))
+        return
+
+    finally:
+        command_list.pop("process", None)
+        command_list.pop("supervised", None)
+
+    stdout.finish()
+    stderr.finish()
+    if is_stopped(command_list, returncode):
+        logger.info("Command was stopped: %s", command_list["killed"])
+        set_command_stopped(options, command_list, output, stdout, command_list["killed"],
+                            returncode, stderr)
+
+    elif returncode == 0:
+        set_command_output(command_list, output, stdout, stderr)
+
+    elif should_retry_expired(logger, options, command_list, stderr.text()):
+        stdout.close()
+        stderr.close()
+        run_command_unsafe(logger, options, command_list)
+
+    else:
+        logger.info("Command returned non-zero exit code")
+        message = format(subprocess.CalledProcessError(returncode, command_list["command"]))
+        set_command_error(command_list, output, stdout, message, returncode, stderr)
@@ -0,0 +1,181 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import os
+import sys
+import time
+import socket
+import calendar
+import threading
+import botocore
+from multiprocessing.pool import ThreadPool
+from . import utils
+
+CREDENTIALS_CACHE_FILE = "credentials.json"
+
+# cached credentials are not used if they expire within this many seconds...
+CACHE_SAFETY_MARGIN = 300
+
+# credentials are refreshed before a command is started if they expire within this many seconds...
+REFRESH_MARGIN = 300
+
+
+def get_session_name():
+    """ the name used for both the STS session name and the external ID """
+    return "{}@{}".format(os.environ["USER"], socket.gethostname())
+
+
+def assume_role(logger, options, sts_client, account_id):
+    """ call STS to get credentials for the account and role... """
+    arn = "arn:aws:iam::{}:role/{}".format(account_id, options.role)
+    logger.debug("Calling STS to get temporary credentials for: %s", arn)
+    assumed_role = sts_client.assume_role(
+        RoleArn=arn,
+        RoleSessionName=get_session_name(),
+        ExternalId=get_session_name()
+    )
+    credentials = dict(assumed_role["Credentials"])
+
+    # keep the expiry time as seconds since the epoch so it can be compared and cached easily...
+    credentials["Expiration"] = calendar.timegm(credentials["Expiration"].utctimetuple())
+    return credentials
+
+
+def assume_role_safe(logger, options, sts_client, account_id):
+    """ wrapper for assume_role that hands back errors rather than raising them """
+    try:
+        return (assume_role(logger, options, sts_client, account_id), None)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        return (None, be_err)
+
+
+def get_cache_key(source_identity, account_id, role):
+    """ credentials are cached per source identity, account and role """
+    return "|".join([source_identity, account_id, role])
+
+
+def load_credentials_cache(logger):
+    """ load the credentials cache from disk, dropping anything that has expired """
+    cache = utils.read_cache_file(logger, CREDENTIALS_CACHE_FILE) or {}
+    now = time.time()
+    return dict((key, value) for key, value in cache.items() if value["Expiration"] > now)
+
+
+def assume_roles(logger, options, sts_client, account_ids):
+    """ assume the role in each account, using the credentials cache if it is enabled """
+    if not options.cache_credentials:
+        return assume_roles_with_pool(logger, options, sts_client, account_ids)
+
+    try:
+        source_identity = sts_client.get_caller_identity()["Arn"]
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        print("error switching role ({}): {}".format(options.role, be_err.args))
+        sys.exit(1)
+    logger.debug("Using the credentials cache for: %s", source_identity)
+    utils.GLOBALS["source_identity"] = source_identity
+    cache = load_credentials_cache(logger)
+    results = {}
+    for account_id in account_ids:
+        cached = cache.get(get_cache_key(source_identity, account_id, options.role))
+        if cached and cached["Expiration"] - CACHE_SAFETY_MARGIN > time.time():
+            results[account_id] = (cached, None)
+
+    missed = [x for x in account_ids if x not in results]
+    logger.info("Credentials cache hits: %s, misses: %s", len(results), len(missed))
+    if missed:
+        for account_id, result in zip(missed, assume_roles_with_pool(logger, options,
+                                                                     sts_client, missed)):
+            results[account_id] = result
+            if result[0] is not None:
+                cache[get_cache_key(source_identity, account_id, options.role)] = result[0]
+        utils.write_cache_file(logger, CREDENTIALS_CACHE_FILE, cache)
+
+    return [results[x] for x in account_ids]
+
+
+def assume_roles_with_pool(logger, options, sts_client, account_ids):
+    """ assume the role in each account across a pool of threads, results are in account order """
+    pool_size = max(1, min(options.threads, len(account_ids)))
+    logger.info("Getting credentials for %s accounts across a thread pool of size: %s",
+                len(account_ids), pool_size)
+    pool = ThreadPool(pool_size)
+    try:
+        return pool.map(lambda x: assume_role_safe(logger, options, sts_client, x), account_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def start_credential_manager(sts_client, account_ids, assumed_roles):
+    """ keep track of the credentials for each account so they can be refreshed during a run """
+    utils.GLOBALS["sts_client"] = sts_client
+    utils.GLOBALS["credentials"] = dict(zip(account_ids, [x[0] for x in assumed_roles]))
+    utils.GLOBALS["credentials_locks"] = dict((x, threading.Lock()) for x in account_ids)
+    utils.GLOBALS["credentials_cache_lock"] = threading.Lock()
+
+
+def update_credentials_cache(logger, options, account_id, credentials):
+    """ write refreshed credentials back to the cache, so the next run does not load the
+        older ones and call STS again """
+    with utils.GLOBALS["credentials_cache_lock"]:
+        cache = load_credentials_cache(logger)
+        cache[get_cache_key(utils.GLOBALS["source_identity"], account_id, options.role)] = \
+            credentials
+        utils.write_cache_file(logger, CREDENTIALS_CACHE_FILE, cache)
+
+
+def set_environment_credentials(env, credentials):
+    """ put credentials into a command environment """
+    env["AWS_ACCESS_KEY_ID"] = credentials["AccessKeyId"]
+    env["AWS_SECRET_ACCESS_KEY"] = credentials["SecretAccessKey"]
+    env["AWS_SESSION_TOKEN"] = credentials["SessionToken"]
+
+
+def get_credentials(logger, options, account_id, expired_key=None):
+    """ get credentials for an account, assuming the role again if they are close to expiry
+        or if expired_key is still the current access key (i.e. a command found it had expired) """
+    with utils.GLOBALS["credentials_locks"][account_id]:
+        current = utils.GLOBALS["credentials"][account_id]
+        expiring = current["Expiration"] - REFRESH_MARGIN < time.time()
+        if expiring or current["AccessKeyId"] == expired_key:
+            logger.info("Refreshing credentials for %s@%s", options.role, account_id)
+            current = assume_role(logger, options, utils.GLOBALS["sts_client"], account_id)
+            utils.GLOBALS["credentials"][account_id] = current
+            if options.cache_credentials:
+                update_credentials_cache(logger, options, account_id, current)
+        return current
+
+
+def refresh_command_credentials(logger, options, cmd, expired=False):
+    """ make sure a command is about to run with credentials that have not (nearly) expired,
+        returns True if the credentials in the command were changed """
+    if not cmd["role"] or "credentials" not in utils.GLOBALS:
+        return False
+    env = cmd["environment"]
+    expired_key = env["AWS_ACCESS_KEY_ID"] if expired else None
+    try:
+        credentials = get_credentials(logger, options, cmd["account_id"], expired_key)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        logger.info("Unable to refresh credentials for %s@%s: %s",
+                    options.role, cmd["account_id"], be_err)
+        return False
+    if credentials["AccessKeyId"] == env["AWS_ACCESS_KEY_ID"]:
+        return False
+    set_environment_credentials(env, credentials)
+    return True
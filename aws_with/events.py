@@ -0,0 +1,183 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    an execution engine that supervises all of the child processes from a single
+    thread using selectors rather than tying up a thread per child (POSIX only)
+"""
+
+import os
+import time
+import signal
+import selectors
+import subprocess
+from . import utils, commands, credentials, executor, capture
+
+READ_SIZE = 65536
+
+# how often to check on children that have closed their output but not yet exited...
+EXIT_POLL_INTERVAL = 0.05
+
+
+def start_command(logger, options, cmd):
+    """ start a command without waiting for it, returns None if it failed to start """
+    credentials.refresh_command_credentials(logger, options, cmd)
+    output = commands.create_command_output(cmd)
+    logger.debug("starting command: %s", output["command"])
+    try:
+        process = subprocess.Popen(cmd["command"], env=commands.get_command_environment(cmd),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False,
+                                   **commands.get_popen_options())
+    except OSError as ose:
+        logger.info("Command failed to start")
+        commands.set_command_error(cmd, output, "", format(ose))
+        return None
+    cmd["process"] = process
+    # the event loop times the command out and kills it if it ignores SIGTERM, not a timer...
+    cmd["supervised"] = True
+    if commands.get_stop_reason():
+        commands.stop_process(logger, cmd, commands.get_stop_reason())
+    timeout_at = time.time() + options.timeout if options.timeout else None
+    return {"cmd":cmd, "output":output, "process":process, "open":2, "timeout_at":timeout_at,
+            "sigkilled":False, "stdout":capture.Buffer(), "stderr":capture.Buffer()}
+
+
+def check_timers(logger, children):
+    """ stop children that have run for longer than --timeout and kill children that are still
+        running KILL_GRACE_PERIOD seconds after being stopped, returns how long until the next
+        of these is due, or None """
+    now = time.time()
+    due = []
+    # the deadline timer stops children from another thread, wake up to kill them later...
+    if utils.GLOBALS.get("deadline") is not None and not utils.GLOBALS.get("deadline_reached"):
+        due.append(max(utils.GLOBALS["deadline"], now + EXIT_POLL_INTERVAL))
+    for child in children:
+        cmd = child["cmd"]
+        if child["timeout_at"] is not None and "killed" not in cmd:
+            if child["timeout_at"] <= now:
+                commands.stop_process(logger, cmd, "timeout")
+            else:
+                due.append(child["timeout_at"])
+        if "killed" in cmd and not child["sigkilled"]:
+            kill_at = cmd["stopped_at"] + commands.KILL_GRACE_PERIOD
+            if kill_at <= now:
+                commands.signal_process(child["process"],
+                                        getattr(signal, "SIGKILL", signal.SIGTERM))
+                child["sigkilled"] = True
+            else:
+                due.append(kill_at)
+    return max(0, min(due) - now) if due else None
+
+
+def finish_command(logger, options, work_queue, child):
+    """ record the output of a child that has exited, in the same way as run_command_unsafe """
+    cmd = child["cmd"]
+    del cmd["process"]
+    del cmd["supervised"]
+    returncode = child["process"].returncode
+    stdout = child["stdout"].finish()
+    stderr = child["stderr"].finish()
+
+    if commands.is_stopped(cmd, returncode):
+        logger.info("Command was stopped: %s", cmd["killed"])
+        commands.set_command_stopped(options, cmd, child["output"], stdout, cmd["killed"],
+                                     returncode, stderr)
+    elif returncode == 0:
+        commands.set_command_output(cmd, child["output"], stdout, stderr)
+    elif commands.should_retry_expired(logger, options, cmd, stderr.text()):
+        stdout.close()
+        stderr.close()
+        work_queue.requeue(cmd)
+        return
+    else:
+        logger.info("Command returned non-zero exit code")
+        message = format(subprocess.CalledProcessError(returncode, cmd["command"]))
+        commands.set_command_error(cmd, child["output"], stdout, message, returncode,
+                                   stderr)
+    work_queue.done(cmd)
+
+
+def start_commands(logger, options, work_queue, selector, children):
+    """ start commands until options.threads are running or the queue has none to give """
+    while len(children) < options.threads:
+        cmd = work_queue.get(False)
+        if cmd is None:
+            break
+        child = start_command(logger, options, cmd)
+        if child is None:
+            work_queue.done(cmd)
+            continue
+        selector.register(child["process"].stdout, selectors.EVENT_READ, (child, "stdout"))
+        selector.register(child["process"].stderr, selectors.EVENT_READ, (child, "stderr"))
+        children.append(child)
+
+
+def execute(logger, options, commands_list, on_done=None):
+    """ run every command with up to options.threads children running at once,
+        calling on_done() as each command finishes """
+    work_queue = executor.WorkQueue(logger, options, commands_list, on_done)
+    work_queue.start_deadline_timer()
+    selector = selectors.DefaultSelector()
+    children = []
+    exiting = []
+    try:
+        while True:
+            # on_done() raised, stop everything...
+            if work_queue.exc_info is not None:
+                raise work_queue.exc_info[1]
+            start_commands(logger, options, work_queue, selector, children)
+            ready_in = work_queue.next_ready_in()
+            if not children:
+                if ready_in is None:
+                    break
+                # nothing is running, only commands waiting to be retried...
+                time.sleep(ready_in)
+                continue
+
+            # read whatever output is ready, a child has finished its output at EOF on both...
+            timeout = min([x for x in [ready_in, check_timers(logger, children),
+                                       EXIT_POLL_INTERVAL if exiting else None]
+                           if x is not None] or [None])
+            for key, _ in selector.select(timeout):
+                child, stream = key.data
+                data = os.read(key.fd, READ_SIZE)
+                if data:
+                    child[stream].write(data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    child["open"] -= 1
+                    if child["open"] == 0:
+                        exiting.append(child)
+
+            for child in [x for x in exiting if x["process"].poll() is not None]:
+                exiting.remove(child)
+                children.remove(child)
+                finish_command(logger, options, work_queue, child)
+
+    except BaseException:
+        for child in children:
+            logger.info("Killing command: %s", child["output"]["command"])
+            commands.signal_process(child["process"], getattr(signal, "SIGKILL", signal.SIGTERM))
+        raise
+
+    finally:
+        selector.close()
+    work_queue.close()
+
+    if work_queue.exc_info is not None:
+        raise work_queue.exc_info[1]
@@ -0,0 +1,407 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import sys
+import time
+import heapq
+import random
+import itertools
+import threading
+import collections
+from . import utils, commands, capture, trace, metrics
+
+# failed commands that can be retried wait a random time of up to this many seconds,
+# doubled for each retry up to the maximum...
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+# commands are only hedged once this many commands have finished, so that the percentile
+# of their durations means something...
+HEDGE_MIN_SAMPLES = 10
+
+# the parts of a command that are copied to start a second (hedged) attempt at it...
+HEDGE_KEYS = ["command", "role", "account_id", "account", "region", "options"]
+
+
+class WorkQueue(object):
+    """ a queue of commands shared by a fixed pool of worker threads, which also limits
+        how many commands can run at once in each region, account and account/region """
+
+    def __init__(self, logger, options, commands_list, on_done=None):
+        self.logger = logger
+        self.options = options
+        self.on_done = on_done
+        self.condition = threading.Condition()
+        self.pending = collections.deque(commands_list)
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.running = 0
+        self.running_by_key = collections.Counter()
+        self.limits = {}
+        self.active = {}
+        self.durations = []
+        self.hedges = 0
+        self.slots = []
+        self.next_slot = 0
+        self.created = time.time()
+        self.exc_info = None
+        self.deadline_timer = None
+
+    def is_cancelled(self):
+        """ work stops being handed out after an error with --stop-on-error, at the deadline
+            for the run or after a worker crash """
+        return self.exc_info is not None or commands.get_stop_reason() is not None
+
+    def get_keys(self, cmd):
+        """ the concurrency limits that apply to a command, with their configured maximum """
+        keys = [(("region", cmd["region"]), self.options.max_per_region),
+                (("account", cmd["account_id"]), self.options.max_per_account),
+                (("target", cmd["account_id"], cmd["region"]), self.options.max_per_target)]
+        maximum = self.options.threads
+        return [(key, limit or maximum) for key, limit in keys
+                if limit or self.options.adaptive]
+
+    def is_runnable(self, cmd):
+        """ check if a command can start without going over any concurrency limits """
+        for key, maximum in self.get_keys(cmd):
+            if self.running_by_key[key] >= int(self.limits.get(key, maximum)):
+                return False
+        return True
+
+    def get(self, block=True):
+        """ get the next command that can be run, or None when there is nothing left to do,
+            if block is False then None is also returned if nothing can be run right now """
+        with self.condition:
+            while not self.is_cancelled():
+                self.release_delayed()
+                for index, cmd in enumerate(self.pending):
+                    if self.is_runnable(cmd):
+                        del self.pending[index]
+                        self.start(cmd)
+                        return cmd
+                cmd = self.get_hedge()
+                if cmd is not None:
+                    self.start(cmd)
+                    return cmd
+                # a running command could still fail and need to be retried...
+                if not block or not (self.pending or self.delayed or self.running):
+                    return None
+                self.condition.wait(self.next_ready_in())
+            return None
+
+    def release_delayed(self):
+        """ move commands that have waited long enough to be retried to the front of the queue """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.pending.appendleft(heapq.heappop(self.delayed)[2])
+
+    def next_ready_in(self):
+        """ the number of seconds until the next command waiting to be retried is ready, or
+            a running command is slow enough to be hedged, or None if there aren't any, commands
+            that can't be hedged because of the concurrency limits are left out, stop() wakes
+            everything up when that might change """
+        with self.condition:
+            if self.is_cancelled():
+                return None
+            times = [x[0] for x in self.delayed[:1]]
+            threshold = self.get_hedge_threshold()
+            if threshold is not None:
+                times.extend([x["attempt_started"] + threshold for x in self.get_hedgeable()
+                              if self.is_runnable(x)])
+            if not times:
+                return None
+            return max(0, min(times) - time.time())
+
+    def get_hedge_threshold(self):
+        """ how long a command can run before it is hedged, or None if it won't be """
+        if not self.options.hedge or len(self.durations) < HEDGE_MIN_SAMPLES or \
+                self.hedges >= int(self.options.threads * self.options.hedge_limit):
+            return None
+        durations = sorted(self.durations)
+        index = int(len(durations) * self.options.hedge_percentile / 100.0)
+        return durations[min(index, len(durations) - 1)]
+
+    def get_hedgeable(self):
+        """ the running commands that could be hedged """
+        return [x for x in self.active.values() if "hedge_pair" not in x and "killed" not in x]
+
+    def get_hedge(self):
+        """ start a second attempt at a command that has been running for longer than the
+            hedging percentile of the commands that have finished, if there is one """
+        threshold = self.get_hedge_threshold()
+        if threshold is None:
+            return None
+        now = time.time()
+        for cmd in self.get_hedgeable():
+            if cmd["attempt_started"] + threshold <= now:
+                hedge = dict((x, cmd[x]) for x in HEDGE_KEYS if x in cmd)
+                hedge["environment"] = dict(cmd["environment"])
+                if not self.is_runnable(hedge):
+                    continue
+                self.logger.info("Hedging command that has been running for %.1fs: %s",
+                                 now - cmd["attempt_started"], " ".join(cmd["command"]))
+                cmd["hedge_pair"] = hedge["hedge_pair"] = {"original":cmd, "hedge":hedge,
+                                                           "running":2, "winner":None}
+                metrics.count_targets("hedged")
+                return hedge
+        return None
+
+    def settle_hedge(self, attempt):
+        """ decide what to do with one of the two attempts at a hedged command as it finishes,
+            returns the command to record the result against, or None if there is nothing to
+            record (yet) """
+        pair = attempt["hedge_pair"]
+        original = pair["original"]
+        pair["running"] -= 1
+        if pair["winner"] is None and pair["running"] > 0 and \
+                ("output" not in attempt or "error" in attempt["output"]):
+            # a failed attempt is thrown away while the other attempt could still succeed...
+            discard_output(attempt)
+            return None
+
+        if pair["winner"] is None:
+            pair["winner"] = attempt
+            if pair["running"] > 0:
+                other = pair["hedge"] if attempt is original else original
+                commands.stop_process(self.logger, other, "hedged")
+                if attempt is original:
+                    original["output"]["hedged"] = True
+                    return original
+                # the original still has to stop before its output can be replaced...
+                return None
+        elif attempt is pair["hedge"]:
+            # the original won and has already been recorded...
+            discard_output(attempt)
+            del original["hedge_pair"]
+            return None
+
+        if pair["winner"] is pair["hedge"]:
+            if attempt is original:
+                discard_output(original)
+            original.pop("killed", None)
+            original["output"] = pair["hedge"]["output"]
+        original["output"]["hedged"] = True
+        del original["hedge_pair"]
+        return original
+
+    def start(self, cmd):
+        """ keep track of a command that is about to run """
+        cmd["attempts"] = cmd.get("attempts", 0) + 1
+        cmd.setdefault("started", time.time())
+        cmd["attempt_started"] = time.time()
+        if "hedge_pair" in cmd:
+            self.hedges += 1
+        if self.slots:
+            cmd["slot"] = heapq.heappop(self.slots)
+        else:
+            cmd["slot"] = self.next_slot
+            self.next_slot += 1
+        self.active[id(cmd)] = cmd
+        self.running += 1
+        for key, _ in self.get_keys(cmd):
+            self.running_by_key[key] += 1
+        metrics.set_concurrency(self.running)
+
+    def stop(self, cmd):
+        """ keep track of a command that is no longer running """
+        del self.active[id(cmd)]
+        heapq.heappush(self.slots, cmd.pop("slot"))
+        if "hedge_pair" in cmd and cmd is cmd["hedge_pair"]["hedge"]:
+            self.hedges -= 1
+        self.running -= 1
+        for key, _ in self.get_keys(cmd):
+            self.running_by_key[key] -= 1
+        metrics.set_concurrency(self.running)
+        self.condition.notify_all()
+
+    def adapt_limits(self, cmd):
+        """ halve the limits for a command that was throttled, otherwise grow them slowly """
+        if not self.options.adaptive or "output" not in cmd:
+            return
+        throttled = commands.is_throttled(cmd["output"])
+        for key, maximum in self.get_keys(cmd):
+            limit = self.limits.get(key, maximum)
+            if throttled:
+                limit = max(1.0, limit / 2.0)
+                self.logger.info("Throttling detected, %s concurrency limit is now: %s",
+                                 "/".join(key), int(limit))
+            else:
+                limit = min(float(maximum), limit + 1.0 / limit)
+            self.limits[key] = limit
+
+    def should_retry(self, cmd):
+        """ check if a command failed in a way that is worth trying again, and has not
+            used up all of its retries """
+        if self.is_cancelled() or "output" not in cmd or "killed" in cmd:
+            return False
+        return cmd.get("retries", 0) < self.options.retries and \
+            commands.is_retryable(cmd["output"])
+
+    def retry(self, cmd):
+        """ throw away the output of a failed command and queue it to run again after a
+            random delay (exponential backoff with full jitter), without holding a worker """
+        cmd["retries"] = cmd.get("retries", 0) + 1
+        metrics.count_retry(cmd["retries"] == 1)
+        backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (cmd["retries"] - 1))
+        delay = random.uniform(0, backoff)
+        self.logger.info("Command failed with a retryable error, retry %s of %s in %.1fs: %s",
+                         cmd["retries"], self.options.retries, delay, cmd["output"]["command"])
+        discard_output(cmd)
+        cmd["queued"] = time.time() + delay
+        heapq.heappush(self.delayed, (cmd["queued"], next(self.sequence), cmd))
+
+    def finish(self, cmd):
+        """ record how a command went once it has finished for good """
+        if "output" not in cmd:
+            return
+        cmd["duration"] = round(time.time() - cmd["started"], 3)
+        self.durations.append(cmd["duration"])
+        metrics.count_targets("failed" if "error" in cmd["output"] else "succeeded")
+        if self.options.retries > 0:
+            cmd["output"]["attempts"] = cmd["attempts"]
+            cmd["output"]["duration"] = cmd["duration"]
+        if "error" in cmd["output"] and self.options.stop_on_error and \
+                not utils.GLOBALS["stop_because_of_error"]:
+            utils.GLOBALS["stop_because_of_error"] = True
+            self.stop_running("stopped")
+
+    def stop_running(self, reason):
+        """ stop all of the commands that are running """
+        for cmd in list(self.active.values()):
+            commands.stop_process(self.logger, cmd, reason)
+
+    def start_deadline_timer(self):
+        """ stop everything when the deadline for the run is reached, if there is one """
+        deadline = utils.GLOBALS.get("deadline")
+        if deadline is not None:
+            self.deadline_timer = threading.Timer(max(0, deadline - time.time()), self.expire)
+            self.deadline_timer.daemon = True
+            self.deadline_timer.start()
+
+    def expire(self):
+        """ the deadline for the run has been reached """
+        self.logger.info("Deadline reached, stopping %s running commands", self.running)
+        with self.condition:
+            utils.GLOBALS["deadline_reached"] = True
+            self.stop_running("deadline")
+            self.condition.notify_all()
+
+    def close(self):
+        """ cancel the deadline timer once everything has stopped, and report the commands the
+            deadline stopped from starting (or from being retried) as errors """
+        if self.deadline_timer is not None:
+            self.deadline_timer.cancel()
+        if not utils.GLOBALS.get("deadline_reached") or self.exc_info is not None:
+            return
+        for cmd in list(self.pending) + [x[2] for x in sorted(self.delayed)]:
+            output = commands.create_command_output(cmd)
+            commands.set_command_error(cmd, output, "", "The deadline for the run was reached "
+                                       "before the command started")
+            output["error"]["reason"] = "deadline"
+            metrics.count_targets("failed")
+            if self.on_done is not None:
+                self.on_done(cmd)
+        self.pending.clear()
+        self.delayed = []
+
+    def done(self, attempt):
+        """ a worker has finished with a command, it always stops counting as running (or the
+            other workers would wait for it forever), if on_done() raises the exception is
+            re-raised once the workers have stopped, like a worker's own """
+        try:
+            with self.condition:
+                trace.add_command_span(attempt, attempt["slot"],
+                                       attempt.get("queued", self.created))
+                self.adapt_limits(attempt)
+                cmd = self.settle_hedge(attempt) if "hedge_pair" in attempt else attempt
+                if cmd is None:
+                    return
+                if self.should_retry(cmd):
+                    self.retry(cmd)
+                    return
+                self.finish(cmd)
+            if self.on_done is not None:
+                self.on_done(cmd)
+        except BaseException:  # pylint: disable=broad-except
+            self.fail(attempt, sys.exc_info())
+        finally:
+            with self.condition:
+                self.stop(attempt)
+                self.logger.debug("commands still remaining: %s",
+                                  len(self.pending) + len(self.delayed) + self.running)
+
+    def requeue(self, cmd):
+        """ put a command that a worker has finished with back at the front of the queue """
+        with self.condition:
+            self.stop(cmd)
+            cmd["queued"] = time.time()
+            self.pending.appendleft(cmd)
+
+    def fail(self, cmd, exc_info):
+        """ a worker crashed while running a command, cancel everything else """
+        self.logger.info("Exception while running command: %s", cmd["command"])
+        with self.condition:
+            if self.exc_info is None:
+                self.exc_info = exc_info
+            self.condition.notify_all()
+
+
+def discard_output(cmd):
+    """ throw away the output of a command, releasing anything it captured """
+    output = cmd.pop("output", {})
+    for key in ["output", "stderr"]:
+        if isinstance(output.get(key), capture.Buffer):
+            output[key].close()
+
+
+def run_worker(logger, options, work_queue, runner):
+    """ keep taking commands from the queue and running them until there are none left """
+    while True:
+        cmd = work_queue.get()
+        if cmd is None:
+            break
+        try:
+            runner(logger, options, cmd)
+        except BaseException:  # pylint: disable=broad-except
+            work_queue.fail(cmd, sys.exc_info())
+        finally:
+            work_queue.done(cmd)
+
+
+def execute(logger, options, commands_list, runner, on_done=None):
+    """ run runner() for every command across a pool of options.threads worker threads,
+        calling on_done() as each command finishes and re-raising the first exception a
+        worker hit once all the workers have stopped """
+    work_queue = WorkQueue(logger, options, commands_list, on_done)
+    work_queue.start_deadline_timer()
+    workers = []
+    for index in range(min(options.threads, len(commands_list))):
+        worker = threading.Thread(target=run_worker, name="worker-{}".format(index),
+                                  args=(logger, options, work_queue, runner))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    logger.debug("Started %s workers, waiting on commands to finish", len(workers))
+    for worker in workers:
+        worker.join()
+    work_queue.close()
+
+    if work_queue.exc_info is not None:
+        raise work_queue.exc_info[1]
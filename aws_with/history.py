@@ -0,0 +1,120 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    remember how long each account and region took to run a command, so that later runs
+    of the same command can start the slowest targets first (--longest-first)
+"""
+
+import time
+import heapq
+from . import utils
+
+HISTORY_FILE = "history.json"
+
+# how much the latest run counts towards a target's expected duration...
+HISTORY_WEIGHT = 0.5
+
+# the history of this many of the most recently run commands is kept...
+MAX_SIGNATURES = 100
+
+
+def get_signature(options):
+    """ durations are kept per command, including any parameters """
+    return " ".join(options.command)
+
+
+def get_target_key(cmd):
+    """ durations are kept per account and region """
+    return "{}/{}".format(cmd["account_id"], cmd["region"])
+
+
+def median(values):
+    """ the median of a list of numbers, or None if it is empty """
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def predict_durations(logger, options, commands_list):
+    """ the expected duration of each command, targets that haven't run the command before
+        are expected to take as long as the median of the other targets in the same region,
+        else the same account, else all targets """
+    history = utils.read_cache_file(logger, HISTORY_FILE) or {}
+    durations = history.get(get_signature(options), {}).get("Targets", {})
+    by_region = {}
+    by_account = {}
+    for key, duration in durations.items():
+        account_id, region = key.split("/", 1)
+        by_region.setdefault(region, []).append(duration)
+        by_account.setdefault(account_id, []).append(duration)
+
+    overall = median(durations.values()) or 0
+    predictions = []
+    for cmd in commands_list:
+        predicted = durations.get(get_target_key(cmd))
+        if predicted is None:
+            predicted = median(by_region.get(cmd["region"], [])) or \
+                median(by_account.get(cmd["account_id"], [])) or overall
+        predictions.append(predicted)
+    logger.info("Command history found for %s of %s targets",
+                len([x for x in commands_list if get_target_key(x) in durations]),
+                len(commands_list))
+    return predictions
+
+
+def get_makespan(threads, durations):
+    """ how long it would take to run commands of these durations in this order on a pool of
+        this many threads, each command starting as soon as a thread is free """
+    finish_times = [0] * max(1, min(threads, len(durations)))
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+
+def order_longest_first(logger, options, commands_list):
+    """ sort the commands so that those expected to take longest start first, returns the
+        sorted list and the predicted time to run it """
+    predictions = predict_durations(logger, options, commands_list)
+    order = sorted(range(len(commands_list)), key=lambda x: -predictions[x])
+    planned = get_makespan(options.threads, predictions)
+    predicted = get_makespan(options.threads, [predictions[x] for x in order])
+    logger.info("Predicted run time: %.1fs longest first, %.1fs in plan order",
+                predicted, planned)
+    return ([commands_list[x] for x in order], predicted)
+
+
+def record_durations(logger, options, commands_list):
+    """ add how long each command took to the history, commands that were stopped before they
+        finished are left out """
+    history = utils.read_cache_file(logger, HISTORY_FILE) or {}
+    entry = history.setdefault(get_signature(options), {"Targets":{}})
+    targets = entry["Targets"]
+    for cmd in [x for x in commands_list if "duration" in x and "killed" not in x]:
+        key = get_target_key(cmd)
+        if key in targets:
+            targets[key] = round(HISTORY_WEIGHT * cmd["duration"] +
+                                 (1 - HISTORY_WEIGHT) * targets[key], 3)
+        else:
+            targets[key] = cmd["duration"]
+    entry["Updated"] = time.time()
+
+    for signature in sorted(history, key=lambda x: history[x]["Updated"])[:-MAX_SIGNATURES]:
+        del history[signature]
+    utils.write_cache_file(logger, HISTORY_FILE, history)
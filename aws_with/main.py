@@ -18,12 +18,11 @@ under the License.
 """
 
 import sys
-import json
-import yaml
 import boto3
 import botocore
+import botocore.config
 
-from . import cli, utils, workplan, commands, output
+from . import cli, utils, workplan, commands, output, trace, metrics
 
 
 def main():
@@ -31,7 +30,7 @@ def main():
 
     # create a dict of globals which are accessed by different threads
     utils.GLOBALS["stop_because_of_error"] = False
-    utils.GLOBALS["thread_count"] = 0
+    utils.GLOBALS["deadline_reached"] = False
 
     # process command line arguments...
     options = cli.check_args()
@@ -39,6 +38,8 @@ def main():
     # setup logging
     logger = utils.setup_logging(options)
     logger.debug("Got optoins: %s", options)
+    trace.start_trace(logger, options)
+    metrics.start_metrics(logger, options)
 
     # if a profile option was specified then set it up...
     if options.profile:
@@ -52,17 +53,23 @@ def main():
     # create boto3 clients...
     logger.debug("Creating AWS clients")
     try:
-        org = boto3.client("organizations")
-        sts = boto3.client("sts")
+        # clients are shared across pools of threads so size their connection pools to match
+        config = botocore.config.Config(max_pool_connections=options.threads)
+        org = trace.trace_client(boto3.client("organizations", config=config))
+        sts = trace.trace_client(boto3.client("sts", config=config))
     except botocore.exceptions.BotoCoreError as bce:
         print("error: " + format(bce))
         sys.exit(1)
 
     # main program logic...
-    workplan.examine_regions(logger, options)
-    workplan.examine_accounts(logger, options, org)
-    workplan.examine_command(logger, options)
-    commands_list = workplan.build_work_plan(logger, options, sts)
+    with trace.span("examine_regions", "phase"):
+        workplan.examine_regions(logger, options)
+    with trace.span("examine_accounts", "phase"):
+        workplan.examine_accounts(logger, options, org)
+    with trace.span("examine_command", "phase"):
+        workplan.examine_command(logger, options)
+    with trace.span("build_work_plan", "phase"):
+        commands_list = workplan.build_work_plan(logger, options, sts)
 
     # make sure we have at least one command to run...
     if not commands_list:
@@ -75,26 +82,23 @@ def main():
         commands.run_command_unsafe(logger, options, commands_list[0])
         sys.exit(0)
 
-    workplan.execute_work_plan(logger, options, commands_list)
-    outputs = output.gather_command_outputs(logger, options, commands_list)
-
-
-    logger.info("Nearly done, collating thread outputs")
-    if options.format == "json":
-        print(json.dumps(outputs, indent=4, sort_keys=True))
-    elif options.format == "yaml":
-        print(yaml.safe_dump(outputs, default_flow_style=False,
-                             encoding="utf-8", allow_unicode=True, indent=4))
-    else:
-        for out in outputs:
-            header = "{}@{} in {}:".format(out["role"], out["account"], out["region"])
-            print("-" * len(header))
-            print(header)
-            print("-" * len(header))
-            print("")
-            print(out["output"])
-            print("")
-            print("")
+    # stream each command's output as soon as it finishes...
+    if options.format == "ndjson":
+        with trace.span("execute_work_plan", "phase"):
+            workplan.execute_work_plan(logger, options, commands_list,
+                                       lambda cmd: output.stream_command_output(logger, options,
+                                                                                cmd))
+        sys.exit(0)
+
+    with trace.span("execute_work_plan", "phase"):
+        workplan.execute_work_plan(logger, options, commands_list)
+    with trace.span("output", "phase"):
+        if options.parallel_output:
+            formatted = output.format_outputs_in_pool(logger, options, commands_list)
+            output.write_formatted_outputs(logger, options, formatted, sys.stdout)
+        else:
+            outputs = output.gather_command_outputs(logger, options, commands_list)
+            output.write_outputs(logger, options, outputs, sys.stdout)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,222 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    keep metrics about a run and write them out in the OpenMetrics/Prometheus text format
+    (--metrics-file), for the node exporter textfile collector to pick up
+"""
+
+import os
+import time
+import atexit
+import threading
+import collections
+from . import utils, commands
+
+# upper bounds (in seconds) of the command duration histogram buckets...
+HISTOGRAM_BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+TARGET_STATES = ["planned", "skipped", "succeeded", "failed", "retried", "hedged"]
+
+
+def start_metrics(logger, options):
+    """ start keeping metrics, they are written to the metrics file when aws_with exits and
+        every options.metrics_interval seconds until then """
+    if not options.metrics_file:
+        return
+    utils.GLOBALS["metrics"] = {
+        "lock":threading.Lock(), "write_lock":threading.Lock(), "finished":False,
+        "started":time.time(), "targets":collections.Counter(),
+        "phases":collections.OrderedDict(), "durations":{}, "api_calls":collections.Counter(),
+        "api_errors":collections.Counter(), "throttling":collections.Counter(),
+        "retries":0, "concurrency":0, "peak_concurrency":0}
+    atexit.register(write_metrics, logger, options, True)
+
+    if options.metrics_interval:
+        writer = threading.Thread(target=write_metrics_periodically, name="metrics",
+                                  args=(logger, options))
+        writer.daemon = True
+        writer.start()
+
+
+def is_enabled():
+    """ check if metrics are being kept """
+    return "metrics" in utils.GLOBALS
+
+
+def count_targets(state, count=1):
+    """ count targets that were planned, skipped, succeeded, failed, retried or hedged """
+    if not is_enabled():
+        return
+    metrics = utils.GLOBALS["metrics"]
+    with metrics["lock"]:
+        metrics["targets"][state] += count
+
+
+def count_retry(first):
+    """ count a retry, the target is counted as retried on its first """
+    if not is_enabled():
+        return
+    metrics = utils.GLOBALS["metrics"]
+    with metrics["lock"]:
+        metrics["retries"] += 1
+        if first:
+            metrics["targets"]["retried"] += 1
+
+
+def set_concurrency(running):
+    """ keep track of how many commands are running at once """
+    if not is_enabled():
+        return
+    metrics = utils.GLOBALS["metrics"]
+    with metrics["lock"]:
+        metrics["concurrency"] = running
+        metrics["peak_concurrency"] = max(metrics["peak_concurrency"], running)
+
+
+def is_throttling_error(message):
+    """ check if an error message says a request was throttled """
+    return any(error in message for error in commands.THROTTLING_ERRORS)
+
+
+def record_span(name, category, started, finished, args):
+    """ take what is needed from a span recorded by the trace module """
+    if not is_enabled():
+        return
+    metrics = utils.GLOBALS["metrics"]
+    with metrics["lock"]:
+        if category == "phase":
+            metrics["phases"][name] = finished - started
+
+        elif category == "api":
+            metrics["api_calls"][tuple(name.split(".", 1))] += 1
+            if "error" in args:
+                metrics["api_errors"][tuple(name.split(".", 1))] += 1
+                if is_throttling_error(args["error"]):
+                    metrics["throttling"]["api"] += 1
+
+        elif category == "command":
+            histogram = metrics["durations"].setdefault(
+                args["region"], {"buckets":[0] * len(HISTOGRAM_BUCKETS), "sum":0, "count":0})
+            duration = finished - started
+            for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+                if duration <= bucket:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += duration
+            histogram["count"] += 1
+            if args.get("throttled"):
+                metrics["throttling"]["command"] += 1
+
+
+def escape(value):
+    """ escape a label value """
+    return format(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def format_sample(name, labels, value):
+    """ a line of the metrics file """
+    if labels:
+        name += "{" + ",".join("{}=\"{}\"".format(key, escape(labels[key]))
+                               for key in sorted(labels)) + "}"
+    return "{} {}".format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def format_metrics(metrics, finished):
+    """ the metrics in the OpenMetrics text format """
+    lines = []
+
+    def add(name, kind, description, samples):
+        """ add a metric family """
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend(format_sample(*sample) for sample in samples)
+
+    now = time.time()
+    add("aws_with_run_in_progress", "gauge", "Whether the run was still going when written.",
+        [("aws_with_run_in_progress", {}, 0 if finished else 1)])
+    add("aws_with_run_start_time_seconds", "gauge", "When the run started.",
+        [("aws_with_run_start_time_seconds", {}, metrics["started"])])
+    add("aws_with_run_duration_seconds", "gauge", "How long the run has taken.",
+        [("aws_with_run_duration_seconds", {}, now - metrics["started"])])
+    add("aws_with_targets", "gauge", "Targets (account and region) by what happened to them.",
+        [("aws_with_targets", {"state":x}, metrics["targets"][x]) for x in TARGET_STATES])
+    add("aws_with_retries", "gauge", "Retries of failed commands, a target may be retried "
+        "more than once.", [("aws_with_retries", {}, metrics["retries"])])
+    add("aws_with_phase_duration_seconds", "gauge", "Time spent in each phase of the run.",
+        [("aws_with_phase_duration_seconds", {"phase":x}, y)
+         for x, y in metrics["phases"].items()])
+    add("aws_with_api_calls", "gauge", "AWS API calls made by aws_with itself.",
+        [("aws_with_api_calls", {"service":x[0], "operation":x[1]}, y)
+         for x, y in sorted(metrics["api_calls"].items())])
+    add("aws_with_api_errors", "gauge", "AWS API calls made by aws_with itself that failed.",
+        [("aws_with_api_errors", {"service":x[0], "operation":x[1]}, y)
+         for x, y in sorted(metrics["api_errors"].items())])
+    add("aws_with_throttling_events", "gauge", "API calls and commands that were throttled.",
+        [("aws_with_throttling_events", {"source":x}, metrics["throttling"][x])
+         for x in ["api", "command"]])
+    add("aws_with_concurrency", "gauge", "Commands running when written.",
+        [("aws_with_concurrency", {}, metrics["concurrency"])])
+    add("aws_with_peak_concurrency", "gauge", "Most commands running at once.",
+        [("aws_with_peak_concurrency", {}, metrics["peak_concurrency"])])
+
+    samples = []
+    for region, histogram in sorted(metrics["durations"].items()):
+        for bucket, count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+            samples.append(("aws_with_command_duration_seconds_bucket",
+                            {"region":region, "le":format(float(bucket))}, count))
+        samples.append(("aws_with_command_duration_seconds_bucket",
+                        {"region":region, "le":"+Inf"}, histogram["count"]))
+        samples.append(("aws_with_command_duration_seconds_sum", {"region":region},
+                        histogram["sum"]))
+        samples.append(("aws_with_command_duration_seconds_count", {"region":region},
+                        histogram["count"]))
+    add("aws_with_command_duration_seconds", "histogram",
+        "How long each attempt at running a command took.", samples)
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(logger, options, finished=False):
+    """ atomically (re)write the metrics file, so that it is never read half written, nothing
+        is written after the final write when aws_with exits """
+    metrics = utils.GLOBALS["metrics"]
+    with metrics["write_lock"]:
+        with metrics["lock"]:
+            if metrics["finished"]:
+                return
+            metrics["finished"] = finished
+            text = format_metrics(metrics, finished)
+        temp_path = "{}.{}.tmp".format(options.metrics_file, os.getpid())
+        logger.debug("Writing metrics file: %s", options.metrics_file)
+        try:
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(text)
+            if hasattr(os, "replace"):
+                os.replace(temp_path, options.metrics_file)
+            else:
+                os.rename(temp_path, options.metrics_file)
+        except (IOError, OSError) as err:
+            # stdout is the command output...
+            logger.error("Unable to write metrics file: %s", err)
+
+
+def write_metrics_periodically(logger, options):
+    """ rewrite the metrics file every options.metrics_interval seconds until the final write """
+    while not utils.GLOBALS["metrics"]["finished"]:
+        time.sleep(options.metrics_interval)
+        write_metrics(logger, options)
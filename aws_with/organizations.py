@@ -17,74 +17,202 @@ specific language governing permissions and limitations
 under the License.
 """
 
+import os
+import time
+import botocore
+from multiprocessing.pool import ThreadPool
 from . import utils
 
+ORG_SNAPSHOT_FILE = "organizations-{}.json"
 
-def get_child_ous(logger, org_client, org_unit):
-    """ given an OU, find all the OUs within that OU... """
-    logger.debug("Getting OUs for: %s", org_unit)
-    result = [org_unit]
+# which Organization was last seen with each profile, so its snapshot can be found without
+# calling Organizations...
+ORG_SNAPSHOT_INDEX_FILE = "organizations.json"
 
-    # for this OU, get all the children...
-    args = dict(ParentId=org_unit["Id"])
-    children = utils.generic_paginator(logger, org_client.list_organizational_units_for_parent,
-                                       "OrganizationalUnits", **args)
+# initial and maximum wait when Organizations tells us to slow down...
+THROTTLE_DELAY = 0.5
+THROTTLE_MAX_DELAY = 8
 
-    # update child paths and then call ourselves recursively to find all children
-    for child in children:
-        child["Path"] = "{}/{}".format(org_unit["Path"], child["Name"]).replace("//", "/")
-        result.extend(get_child_ous(logger, org_client, child))
 
+def create_ou_entry(org_unit, path):
+    """ create the index entry for an OU, children and accounts are fetched when needed """
+    return {"Id":org_unit["Id"], "Name":org_unit.get("Name", ""), "Path":path,
+            "Children":None, "Accounts":None}
+
+
+def create_org_index(logger, org_client):
+    """ create an index of OU id to path/children/accounts that starts with just the root """
+    logger.debug("Creating an index of the Organization")
+    root = org_client.list_roots()["Roots"][0]
+    return {"Root":root["Id"], "OUs":{root["Id"]:create_ou_entry(root, "/")}}
+
+
+def get_index_children(logger, org_client, index, org_unit):
+    """ get the child OUs of an OU, asking Organizations the first time only """
+    if org_unit["Children"] is None:
+        args = dict(ParentId=org_unit["Id"])
+        children = utils.generic_paginator(logger, org_client.list_organizational_units_for_parent,
+                                           "OrganizationalUnits", **args)
+        for child in children:
+            path = "{}/{}".format(org_unit["Path"], child["Name"]).replace("//", "/")
+            index["OUs"].setdefault(child["Id"], create_ou_entry(child, path))
+        org_unit["Children"] = [x["Id"] for x in children]
+    return [index["OUs"][x] for x in org_unit["Children"]]
+
+
+def get_index_accounts(logger, org_client, org_unit):
+    """ get the accounts directly within an OU, asking Organizations the first time only """
+    if org_unit["Accounts"] is None:
+        args = {"ParentId":org_unit["Id"]}
+        accounts = utils.generic_paginator(logger, org_client.list_accounts_for_parent,
+                                           "Accounts", **args)
+        for acc in accounts:
+            acc["Path"] = org_unit["Path"]
+            # timestamps can't be stored as JSON...
+            if "JoinedTimestamp" in acc:
+                acc["JoinedTimestamp"] = format(acc["JoinedTimestamp"])
+        org_unit["Accounts"] = accounts
+    return org_unit["Accounts"]
+
+
+def fetch_ou(logger, org_client, index, org_unit, with_accounts):
+    """ fetch the children (and optionally accounts) of an OU, returns False if throttled """
+    try:
+        get_index_children(logger, org_client, index, org_unit)
+        if with_accounts:
+            get_index_accounts(logger, org_client, org_unit)
+        return True
+    except botocore.exceptions.ClientError as be_ce:
+        if be_ce.response["Error"]["Code"] != "TooManyRequestsException":
+            raise
+        logger.debug("Throttled by Organizations fetching: %s", org_unit["Path"])
+        return False
+
+
+def fetch_ous(logger, options, org_client, index, pool, org_units, with_accounts):
+    """ fetch a list of OUs on a pool, halving the concurrency each time we are throttled and
+        growing it again by one for each batch that isn't """
+    max_concurrency = max(1, options.threads)
+    concurrency = max_concurrency
+    delay = THROTTLE_DELAY
+    pending = list(org_units)
+    while pending:
+        batch, pending = pending[:concurrency], pending[concurrency:]
+        fetched = pool.map(lambda x: fetch_ou(logger, org_client, index, x, with_accounts),
+                           batch)
+        throttled = [org_unit for org_unit, ok in zip(batch, fetched) if not ok]
+        if throttled:
+            concurrency = max(1, concurrency // 2)
+            logger.info("Organizations is throttling requests, concurrency reduced to: %s",
+                        concurrency)
+            time.sleep(delay)
+            delay = min(delay * 2, THROTTLE_MAX_DELAY)
+            pending = throttled + pending
+        else:
+            concurrency = min(max_concurrency, concurrency + 1)
+            delay = THROTTLE_DELAY
+
+
+def get_child_ous(logger, options, org_client, index, org_unit, with_accounts=False):
+    """ given an OU, find all the OUs within that OU, a level at a time across a thread pool... """
+    logger.debug("Getting OUs for: %s", org_unit["Path"])
+    result = []
+    level = [org_unit]
+    pool = ThreadPool(max(1, options.threads))
+    try:
+        while level:
+            result.extend(level)
+            fetch_ous(logger, options, org_client, index, pool, level, with_accounts)
+            level = utils.flatten_list([get_index_children(logger, org_client, index, x)
+                                        for x in level])
+    finally:
+        pool.close()
+        pool.join()
     return result
 
 
-def get_ou_from_path(logger, org_client, path):
+def get_ou_from_path(logger, org_client, index, path):
     """ given a path, traverse Organizations OUs to locate the required OU... """
     logger.debug("Getting OU from path: %s", path)
 
-    current_ou = org_client.list_roots()["Roots"][0]["Id"]
+    current_ou = index["OUs"][index["Root"]]
     if path == "/":
-        return {"Id":current_ou, "Path":path}
+        return current_ou
 
     for dir_name in path.split("/")[1:]:
         logger.debug("Getting OU from path: %s, looking for: %s", path, dir_name)
-        found = False
-        args = dict(ParentId=current_ou)
-        children = utils.generic_paginator(logger, org_client.list_organizational_units_for_parent,
-                                           "OrganizationalUnits", **args)
-
-        for org_unit in children:
-            if org_unit["Name"] == dir_name:
-                current_ou = org_unit["Id"]
-                found = True
-                break
-
-        if not found:
+        children = get_index_children(logger, org_client, index, current_ou)
+        matched = [x for x in children if x["Name"] == dir_name]
+        if not matched:
             raise ValueError("OU path not found")
+        current_ou = matched[0]
 
-    return {"Id":current_ou, "Path":path}
+    return current_ou
 
 
-def get_accounts_for_ou(logger, options, org_client, path):
+def get_accounts_for_ou(logger, options, org_client, index, path):
     """ given a path, get all the AWS accounts within that part of an Organization... """
     logger.debug("Getting accounts for OU: %s", path)
-    org_unit = get_ou_from_path(logger, org_client, path)
+    org_unit = get_ou_from_path(logger, org_client, index, path)
     ous = []
     if options.no_recursive:
         ous.append(org_unit)
     else:
-        ous.extend(get_child_ous(logger, org_client, org_unit))
+        ous.extend(get_child_ous(logger, options, org_client, index, org_unit, True))
 
     result = []
     for org_unit in ous:
-        args = {"ParentId":org_unit["Id"]}
-        accounts = utils.generic_paginator(logger, org_client.list_accounts_for_parent,
-                                           "Accounts", **args)
-        for acc in accounts:
-            acc["Path"] = org_unit["Path"]
+        for acc in get_index_accounts(logger, org_client, org_unit):
             if 'Status' in acc:
                 if acc['Status'] != 'SUSPENDED':
                     result.append(acc)
                 else:
                     logger.info("found suspended account %s, ignoring it." % acc)
     return result
+
+
+def get_accounts_for_ous(logger, options, org_client, index, paths):
+    """ get the accounts for a number of paths, each account is only returned once """
+    result = []
+    seen = set()
+    for path in paths:
+        for acc in get_accounts_for_ou(logger, options, org_client, index, path):
+            if acc["Id"] not in seen:
+                seen.add(acc["Id"])
+                result.append(acc)
+    return result
+
+
+def create_org_snapshot(logger, options, org_client, organization):
+    """ walk the whole Organization to record every OU and the accounts within them """
+    logger.info("Creating a snapshot of Organization: %s", organization["Id"])
+    snapshot = create_org_index(logger, org_client)
+    snapshot["Created"] = time.time()
+    snapshot["Organization"] = organization
+    get_child_ous(logger, options, org_client, snapshot, snapshot["OUs"][snapshot["Root"]], True)
+    return snapshot
+
+
+def get_snapshot_key(options):
+    """ snapshots are looked up by the profile (or the access key) aws_with was run with """
+    return options.profile or os.environ.get("AWS_PROFILE") or \
+        os.environ.get("AWS_ACCESS_KEY_ID") or "default"
+
+
+def get_org_snapshot(logger, options, org_client):
+    """ get a snapshot of the Organization, from the cache if it is recent enough, in which case
+        Organizations isn't called at all """
+    key = get_snapshot_key(options)
+    snapshot_index = utils.read_cache_file(logger, ORG_SNAPSHOT_INDEX_FILE) or {}
+    if not options.refresh_org and key in snapshot_index:
+        snapshot = utils.read_cache_file(logger, ORG_SNAPSHOT_FILE.format(snapshot_index[key]))
+        if snapshot and snapshot["Created"] + options.org_cache_ttl > time.time():
+            logger.info("Using cached snapshot of Organization: %s", snapshot_index[key])
+            return snapshot
+
+    organization = org_client.describe_organization()["Organization"]
+    snapshot = create_org_snapshot(logger, options, org_client, organization)
+    utils.write_cache_file(logger, ORG_SNAPSHOT_FILE.format(organization["Id"]), snapshot)
+    snapshot_index[key] = organization["Id"]
+    utils.write_cache_file(logger, ORG_SNAPSHOT_INDEX_FILE, snapshot_index)
+    return snapshot
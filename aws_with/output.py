@@ -17,33 +17,230 @@ specific language governing permissions and limitations
 under the License.
 """
 
+import sys
+import json
+import types
+import logging
+import threading
+import collections
+import multiprocessing
+import yaml
+from . import capture
+
+OUTPUT_LOCK = threading.Lock()
+
+# stands in for output that is copied straight into the JSON document without being parsed...
+PASSTHROUGH = "\0aws_with-passthrough\0"
+
+
+def is_passthrough(options, cmd):
+    """ check if a command's output can be copied into the JSON document as it is, which is
+        only done for AWS CLI JSON output when nothing needs to look inside it """
+    record = cmd["output"]
+    if options.format != "json" or options.quiet or options.no_passthrough or \
+            "error" in record or not isinstance(record["output"], capture.Buffer):
+        return False
+
+    command = cmd["command"]
+    if command[0] != "aws" or ("--output" in command[:-1] and
+                               command[command.index("--output") + 1] != "json"):
+        return False
+    return record["output"].ends() in [(b"{", b"}"), (b"[", b"]")]
+
+
+def load_output(record, passthrough=False):
+    """ turn a command's captured output into the record that is printed, reading spilled
+        output back from disk and parsing JSON output, the captured buffers are released
+        except for passthrough output which is left to be copied as it is printed """
+    record = dict(record)
+    for key in ["output", "stderr"] if not passthrough else ["stderr"]:
+        if isinstance(record.get(key), capture.Buffer):
+            buffer = record[key]
+            record[key] = buffer.text()
+            buffer.close()
+
+    # only keep stderr if there was something on it...
+    if "stderr" in record and not record["stderr"]:
+        del record["stderr"]
+
+    # try and parse the command output as JSON...
+    if "error" not in record and not passthrough:
+        try:
+            record["output"] = json.loads(record["output"])
+        except (ValueError, SyntaxError, TypeError):
+            pass
+    return record
+
+
+def is_output_suppressed(logger, options, record):
+    """ check if a command's output should be suppressed by --quiet, which only hides
+        commands that were successful """
+    if not options.quiet or "skipped" in record or "error" in record:
+        return False
+
+    command_output = record["output"]
+    logger.debug("Command output: %s", command_output)
+    oo_single_empty_key = False
+    if isinstance(command_output, dict):
+        oo_key_count = len(command_output.keys())
+        oo_single_key = oo_key_count == 1
+        if oo_single_key:
+            oo_key_values = len(command_output[list(command_output.keys())[0]])
+            oo_single_empty_key = oo_key_values == 0
+
+    # check for literally no output...
+    if command_output is None or command_output == "":
+        logger.debug("Command output is actually empty, skipping: %s", record)
+        return True
+
+    # check if output contains a single empty object...
+    if oo_single_empty_key:
+        logger.debug("Command output is effectively empty, skipping: %s", record)
+        return True
+
+    return False
+
 
 def gather_command_outputs(logger, options, commands_list):
-    """ gather the command outputs together """
-    outputs = []
+    """ gather the command outputs together, in plan order, one at a time """
     for cmd in commands_list:
-
         # check if we have an output object that shouldn't be suppressed from --quiet...
         if "output" in cmd.keys():
-            command_output = cmd["output"]["output"]
-            logger.debug("Command output: %s", command_output)
-            oo_single_key = False
-            oo_single_empty_key = False
-            if isinstance(command_output, dict):
-                oo_key_count = len(command_output.keys())
-                oo_single_key = oo_key_count == 1
-                if oo_single_key:
-                    oo_key_values = len(command_output[list(command_output.keys())[0]])
-                    oo_single_empty_key = oo_key_values == 0
-
-            # check for literally no output...
-            if options.quiet and (command_output is None or command_output == ""):
-                logger.debug("Command output is actually empty, skipping: %s", cmd["output"])
-
-            # check if output contains a single empty object...
-            elif options.quiet and oo_single_empty_key:
-                logger.debug("Command output is effectively empty, skipping: %s", cmd["output"])
+            record = load_output(cmd["output"], is_passthrough(options, cmd))
+            if not is_output_suppressed(logger, options, record):
+                yield record
+
+
+def format_output(options, record):
+    """ format a single output record, returned as a list of pieces of text """
+    if options.format == "json" and isinstance(record["output"], capture.Buffer):
+        text = json.dumps(dict(record, output=PASSTHROUGH), indent=4, sort_keys=True)
+        prefix, suffix = text.replace("\n", "\n    ").split(json.dumps(PASSTHROUGH))
+        return ["    " + prefix, passthrough_output(record["output"]), suffix]
 
+    if options.format == "json":
+        text = json.dumps(record, indent=4, sort_keys=True)
+        return ["    " + text.replace("\n", "\n    ")]
+    elif options.format == "yaml":
+        return [yaml.safe_dump([record], default_flow_style=False, allow_unicode=True,
+                               indent=4)]
+
+    header = "{}@{} in {}:".format(record["role"], record["account"], record["region"])
+    lines = ["-" * len(header), header, "-" * len(header), ""]
+    if "skipped" in record:
+        lines.append("skipped: {}".format(record["skipped"]))
+    else:
+        lines.append(format(record["output"]))
+    return ["\n".join(lines + ["", "", ""])]
+
+
+def passthrough_output(buffer):
+    """ copy JSON output as it is, just indented to fit in the document and without the
+        whitespace at each end, and then release the buffer """
+    pending = ""
+    first = True
+    for piece in buffer.iter_text():
+        piece = pending + piece
+        if first:
+            piece = piece.lstrip()
+            first = not piece
+        stripped = piece.rstrip()
+        pending = piece[len(stripped):]
+        if stripped:
+            yield stripped.replace("\n", "\n        ")
+    buffer.close()
+
+
+def write_outputs(logger, options, outputs, stream):
+    """ write the output records to stream one at a time so only one of them needs to be in
+        memory, the result is the same as formatting a list of all of them at once """
+    write_formatted_outputs(logger, options, (format_output(options, x) for x in outputs), stream)
+
+
+def write_formatted_outputs(logger, options, formatted_outputs, stream):
+    """ write output records that have already been formatted by format_output() """
+    logger.info("Nearly done, collating thread outputs")
+    count = 0
+    for pieces in formatted_outputs:
+        if options.format == "json":
+            stream.write("[\n" if count == 0 else ",\n")
+        for piece in pieces:
+            if isinstance(piece, types.GeneratorType):
+                for text in piece:
+                    stream.write(text)
             else:
-                outputs.append(cmd["output"])
-    return outputs
+                stream.write(piece)
+        count += 1
+
+    if options.format == "json":
+        stream.write("\n]\n" if count else "[]\n")
+    elif options.format == "yaml" and not count:
+        stream.write("[]\n")
+    if options.format == "yaml":
+        stream.write("\n")
+    stream.flush()
+
+
+def render_output(options, record):
+    """ parse, check and format a single output record, this runs in a worker process so
+        returns the formatted text, or None if --quiet suppresses it """
+    logger = logging.getLogger("aws_with")
+    record = load_output(record)
+    if is_output_suppressed(logger, options, record):
+        return None
+    return "".join(format_output(options, record))
+
+
+def format_outputs_in_pool(logger, options, commands_list):
+    """ like gather_command_outputs() followed by format_output(), but with the parsing and
+        formatting spread across a process pool, results still come back in plan order and
+        only a few outputs per process are in flight at once """
+    pool_size = multiprocessing.cpu_count()
+    logger.info("Formatting outputs across a process pool of size: %s", pool_size)
+    pool = multiprocessing.Pool(pool_size)
+    in_flight = collections.deque()
+    try:
+        for cmd in [x for x in commands_list if "output" in x.keys()]:
+            if is_passthrough(options, cmd):
+                # passthrough output is only copied, so there is nothing to gain from a worker...
+                in_flight.append((cmd, None))
+            else:
+                in_flight.append((cmd, pool.apply_async(render_output, (options, cmd["output"]))))
+
+            while in_flight and (len(in_flight) > pool_size * 4 or in_flight[0][1] is None):
+                for pieces in finish_render(options, *in_flight.popleft()):
+                    yield pieces
+
+        while in_flight:
+            for pieces in finish_render(options, *in_flight.popleft()):
+                yield pieces
+    finally:
+        pool.terminate()
+
+
+def finish_render(options, cmd, result):
+    """ collect a formatted output from the pool (or format passthrough output here) and
+        release the captured output that was sent to the pool """
+    if result is None:
+        yield format_output(options, load_output(cmd["output"], True))
+        return
+    text = result.get()
+    for key in ["output", "stderr"]:
+        if isinstance(cmd["output"].get(key), capture.Buffer):
+            cmd["output"][key].close()
+    if text is not None:
+        yield [text]
+
+
+def stream_command_output(logger, options, cmd):
+    """ write a command's output as a single line of JSON as soon as the command is done,
+        and then forget it so memory use doesn't grow with the number of commands """
+    if "output" not in cmd.keys():
+        return
+    record = load_output(cmd["output"])
+    del cmd["output"]
+    if not is_output_suppressed(logger, options, record):
+        line = json.dumps(record, sort_keys=True)
+        with OUTPUT_LOCK:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
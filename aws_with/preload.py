@@ -0,0 +1,175 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    run AWS CLI commands inside a pool of worker processes that have already imported
+    awscli and loaded its data, rather than starting a fresh `aws` process per target
+"""
+
+import io
+import os
+import sys
+import time
+import signal
+import locale
+import importlib
+import traceback
+import subprocess
+import multiprocessing
+from . import utils, commands, credentials, capture
+
+# the data loader of the first CLI driver in a worker, shared by later drivers so that
+# service models are only read from disk once per worker...
+WORKER = {}
+
+
+class CommandTimeout(BaseException):
+    """ raised in a worker when a command runs for too long, this is not an Exception so that
+        the AWS CLI doesn't catch it """
+
+
+def raise_timeout(signum, frame):  # pylint: disable=unused-argument
+    """ SIGALRM handler for workers """
+    raise CommandTimeout()
+
+
+def init_worker():
+    """ import awscli and load its data once when a worker process starts """
+    import awscli.clidriver
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, raise_timeout)
+    WORKER["data_loader"] = awscli.clidriver.create_clidriver().session.get_component(
+        "data_loader")
+
+
+def open_output(path):
+    """ open one of the files a worker writes a command's output to, encoded as `aws` would
+        encode it when run as a child process """
+    return io.TextIOWrapper(io.open(path, "wb"), encoding=locale.getpreferredencoding(False),
+                            errors="replace", write_through=True)
+
+
+def run_cli(command, env, stdout_path, stderr_path, timeout=None):
+    """ run an AWS CLI command in a worker, writing the stdout and stderr output to the files
+        the parent captures them in just as if `aws` had been run as a child process, returns
+        the exit code and whether it timed out """
+    import awscli.clidriver
+    os.environ.clear()
+    os.environ.update(env)
+    stdout = open_output(stdout_path)
+    stderr = open_output(stderr_path)
+    saved = (sys.stdout, sys.stderr)
+    sys.stdout, sys.stderr = stdout, stderr
+    timed_out = False
+    try:
+        if timeout is not None and hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+        driver = awscli.clidriver.create_clidriver()
+        driver.session.register_component("data_loader", WORKER["data_loader"])
+        returncode = driver.main(command[1:])
+    except SystemExit as sys_exit:
+        returncode = sys_exit.code if isinstance(sys_exit.code, int) else 1
+    except Exception:  # pylint: disable=broad-except
+        # behave like a child process that crashed...
+        traceback.print_exc(file=stderr)
+        returncode = 255
+    except CommandTimeout:
+        timed_out = True
+        returncode = None
+    finally:
+        if timeout is not None and hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        sys.stdout, sys.stderr = saved
+        stdout.close()
+        stderr.close()
+    return (returncode, timed_out)
+
+
+def get_timeout(options):
+    """ how long a command can run in a worker, and the reason it would be stopped """
+    remaining = None
+    if utils.GLOBALS.get("deadline") is not None:
+        remaining = utils.GLOBALS["deadline"] - time.time()
+    if options.timeout and (remaining is None or options.timeout <= remaining):
+        return (options.timeout, "timeout")
+    return (remaining, "deadline")
+
+
+def start_pool(logger, options):
+    """ start the pool of worker processes, returns False if awscli isn't available """
+    try:
+        importlib.import_module("awscli.clidriver")
+    except ImportError:
+        logger.info("awscli module not found or failed to load, not using --preload-cli")
+        return False
+
+    # the forkserver can import awscli once and then fork every worker from itself...
+    if hasattr(multiprocessing, "get_context") and \
+            "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["awscli.clidriver"])
+    else:
+        context = multiprocessing
+    logger.info("Starting %s AWS CLI worker processes", options.threads)
+    utils.GLOBALS["cli_pool"] = context.Pool(options.threads, init_worker)
+    return True
+
+
+def stop_pool():
+    """ shut down the pool of worker processes """
+    utils.GLOBALS.pop("cli_pool").terminate()
+
+
+def run_command_unsafe(logger, options, command_list):
+    """ run an AWS CLI command in the worker pool, output is recorded exactly as
+        commands.run_command_unsafe records it """
+
+    if commands.get_stop_reason():
+        return
+
+    credentials.refresh_command_credentials(logger, options, command_list)
+    env = dict(commands.get_command_environment(command_list))
+    output = commands.create_command_output(command_list)
+
+    # the worker writes straight to the files the output is captured in, rather than sending
+    # it all back to be held in memory...
+    stdout = capture.Buffer()
+    stderr = capture.Buffer()
+    stdout.open_file()
+    stderr.open_file()
+
+    # a worker can't be killed without losing it from the pool, so it stops itself instead...
+    timeout, reason = get_timeout(options)
+    returncode, timed_out = utils.GLOBALS["cli_pool"].apply(
+        run_cli, (command_list["command"], env, stdout.path, stderr.path, timeout))
+    stdout.finish()
+    stderr.finish()
+    if timed_out:
+        logger.info("Command was stopped: %s", reason)
+        commands.set_command_stopped(options, command_list, output, stdout, reason, returncode,
+                                     stderr)
+    elif returncode == 0:
+        commands.set_command_output(command_list, output, stdout, stderr)
+    elif commands.should_retry_expired(logger, options, command_list, stderr.text()):
+        stdout.close()
+        stderr.close()
+        run_command_unsafe(logger, options, command_list)
+    else:
+        logger.info("Command returned non-zero exit code")
+        message = format(subprocess.CalledProcessError(returncode, command_list["command"]))
+        commands.set_command_error(command_list, output, stdout, message, returncode,
+                                   stderr)
@@ -18,19 +18,104 @@ under the License.
 """
 
 import re
+import time
 import boto3
-from . import utils
+import botocore
+from multiprocessing.pool import ThreadPool
+from . import utils, trace
 
+REGIONS_CACHE_FILE = "regions.json"
+ENABLED_REGIONS_CACHE_FILE = "enabled-regions.json"
 
-def get_regions_list(logger):
-    """ get a list of AWS regions """
+
+def get_regions_list(logger, options):
+    """ get a list of AWS regions, from the cache if it is recent enough """
+    cache = utils.read_cache_file(logger, REGIONS_CACHE_FILE) if options.region_cache_ttl else None
+    if cache and cache["Created"] + options.region_cache_ttl > time.time():
+        logger.debug("using cached list of AWS regions")
+        return cache["Regions"]
+
+    try:
+        regions_list = describe_regions(logger)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        logger.info("unable to get a list of AWS regions from EC2: %s", be_err)
+        if cache:
+            logger.info("using expired cached list of AWS regions")
+            return cache["Regions"]
+        return get_bundled_regions_list(logger)
+
+    if options.region_cache_ttl:
+        utils.write_cache_file(logger, REGIONS_CACHE_FILE,
+                               {"Created":time.time(), "Regions":regions_list})
+    return regions_list
+
+
+def describe_regions(logger):
+    """ ask EC2 for a list of AWS regions """
     logger.debug("getting a list of AWS regions...")
-    ec2 = boto3.client("ec2", region_name="us-east-1")
+    ec2 = trace.trace_client(boto3.client("ec2", region_name="us-east-1"))
     return utils.generic_paginator(logger, ec2.describe_regions, "Regions")
 
+
+def get_bundled_regions_list(logger):
+    """ get a list of AWS regions from the endpoint data that comes with botocore """
+    logger.info("using the list of AWS regions bundled with botocore")
+    regions_list = boto3.session.Session().get_available_regions("ec2")
+    return [{"RegionName":x} for x in regions_list]
+
+def is_region_pattern(regex):
+    """ check if a region needs to be expanded from the list of regions or is just a name """
+    return any(x in regex for x in "*.?+^$|[](){}\\")
+
+
 def get_regions_from_regex(logger, regex, region_list):
     """ search the regions list using regular expressions """
     logger.debug("getting regions that match: %s", regex)
     regex_pattern = re.compile("^" + regex.replace("*", ".*") + "$")
     filtered_regions = filter(lambda x: regex_pattern.match(x["RegionName"]), region_list)
     return map(lambda x: x["RegionName"], filtered_regions)
+
+
+def describe_enabled_regions(logger, options, account_id, credentials):
+    """ ask EC2 which regions are enabled in an account, returns None if we can't tell """
+    logger.debug("getting a list of enabled regions for: %s", account_id)
+    if credentials:
+        session = boto3.session.Session(aws_access_key_id=credentials["AccessKeyId"],
+                                        aws_secret_access_key=credentials["SecretAccessKey"],
+                                        aws_session_token=credentials["SessionToken"])
+    else:
+        session = boto3.session.Session(profile_name=options.profile)
+    try:
+        ec2 = trace.trace_client(session.client("ec2", region_name="us-east-1"))
+        return [x["RegionName"] for x in ec2.describe_regions()["Regions"]]
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as be_err:
+        logger.info("unable to get a list of enabled regions for %s: %s", account_id, be_err)
+        return None
+
+
+def get_enabled_regions(logger, options, account_ids, credentials_list):
+    """ get the regions enabled in each account (or None if unknown), in account order """
+    cache = utils.read_cache_file(logger, ENABLED_REGIONS_CACHE_FILE) or {}
+    now = time.time()
+    cache = dict((key, value) for key, value in cache.items()
+                 if value["Created"] + options.region_cache_ttl > now)
+
+    missed = [(account_id, credentials) for account_id, credentials
+              in zip(account_ids, credentials_list) if account_id not in cache]
+    logger.info("Enabled regions cache hits: %s, misses: %s",
+                len(account_ids) - len(missed), len(missed))
+    if missed:
+        pool = ThreadPool(max(1, min(options.threads, len(missed))))
+        try:
+            enabled = pool.map(lambda x: describe_enabled_regions(logger, options, x[0], x[1]),
+                               missed)
+        finally:
+            pool.close()
+            pool.join()
+        for (account_id, _), regions_list in zip(missed, enabled):
+            if regions_list is not None:
+                cache[account_id] = {"Created":now, "Regions":regions_list}
+        if options.region_cache_ttl:
+            utils.write_cache_file(logger, ENABLED_REGIONS_CACHE_FILE, cache)
+
+    return [cache[x]["Regions"] if x in cache else None for x in account_ids]
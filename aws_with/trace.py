@@ -0,0 +1,166 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    record spans for the phases of a run, AWS API calls and commands (--trace), written out
+    in the Chrome trace event format so they can be viewed in chrome://tracing or Perfetto
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+import collections
+from . import utils, commands, metrics
+
+
+def start_trace(logger, options):
+    """ start recording spans, they are written to the trace file when aws_with exits """
+    if not options.trace:
+        return
+    utils.GLOBALS["trace"] = {"lock":threading.Lock(), "spans":[], "tids":{}}
+    atexit.register(write_trace, logger, options)
+
+
+def is_tracing():
+    """ check if spans are being recorded """
+    return "trace" in utils.GLOBALS
+
+
+def get_tid(trace, track):
+    """ each thread (or command slot) is shown as a track of its own """
+    if track not in trace["tids"]:
+        trace["tids"][track] = len(trace["tids"])
+    return trace["tids"][track]
+
+
+def add_span(name, category, started, finished, args=None, track=None):
+    """ record something that happened between started and finished """
+    metrics.record_span(name, category, started, finished, args or {})
+    if not is_tracing():
+        return
+    trace = utils.GLOBALS["trace"]
+    with trace["lock"]:
+        trace["spans"].append({
+            "name":name, "cat":category, "ph":"X", "pid":os.getpid(),
+            "tid":get_tid(trace, track or threading.current_thread().name),
+            "ts":int(started * 1000000), "dur":int((finished - started) * 1000000),
+            "args":args or {}})
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """ record the time spent in a with block """
+    started = time.time()
+    try:
+        yield
+    finally:
+        add_span(name, category, started, time.time(), args)
+
+
+def add_command_span(cmd, slot, queued):
+    """ record an attempt at running a command, which was waiting to run since queued """
+    if not is_tracing() and not metrics.is_enabled():
+        return
+    output = cmd.get("output", {})
+    args = {"account":cmd["account_id"], "region":cmd["region"],
+            "thread":threading.current_thread().name, "attempt":cmd["attempts"],
+            "queue_wait":round(cmd["attempt_started"] - queued, 6)}
+    if "error" in output:
+        args["exit_code"] = output["error"].get("returncode")
+        args["error"] = output["error"]["message"]
+        args["throttled"] = commands.is_throttled(output)
+    elif "output" in output:
+        args["exit_code"] = 0
+    if "killed" in cmd:
+        args["stopped"] = cmd["killed"]
+    if "hedge_pair" in cmd:
+        args["hedged"] = True
+    add_span(" ".join(cmd["command"]), "command", cmd["attempt_started"], time.time(), args,
+             "slot {}".format(slot))
+
+
+def trace_client(client):
+    """ record a span for each API call made with a boto3 client """
+    if not is_tracing() and not metrics.is_enabled():
+        return client
+    region = client.meta.region_name
+
+    def before_call(context, **_):
+        """ note when the call started """
+        context["aws_with_trace_started"] = time.time()
+
+    def after_call(event_name, context, **kwargs):
+        """ record the call, the event name is after-call(-error).SERVICE.OPERATION, service
+            errors (throttling, access denied...) come with after-call, after-call-error is
+            only sent when no response was received """
+        if "aws_with_trace_started" not in context:
+            return
+        args = {"region":region}
+        if "exception" in kwargs:
+            args["error"] = format(kwargs["exception"])
+        else:
+            error = (kwargs.get("parsed") or {}).get("Error", {})
+            status_code = getattr(kwargs.get("http_response"), "status_code", 200)
+            if error.get("Code") or status_code >= 300:
+                args["error"] = "{} ({}): {}".format(error.get("Code", "HTTP"), status_code,
+                                                     error.get("Message", ""))
+        add_span(".".join(event_name.split(".")[1:3]), "api",
+                 context.pop("aws_with_trace_started"), time.time(), args)
+
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("after-call", after_call)
+    client.meta.events.register("after-call-error", after_call)
+    return client
+
+
+def summarise(logger, spans):
+    """ log a table of where the time went """
+    rows = collections.OrderedDict()
+    for item in spans:
+        key = (item["cat"], item["name"] if item["cat"] != "command" else "commands")
+        row = rows.setdefault(key, {"count":0, "total":0, "max":0, "wait":0})
+        row["count"] += 1
+        row["total"] += item["dur"] / 1000000.0
+        row["max"] = max(row["max"], item["dur"] / 1000000.0)
+        row["wait"] += item["args"].get("queue_wait", 0)
+
+    logger.info("%-8s %-48s %7s %10s %10s %10s", "type", "name", "count", "total(s)",
+                "max(s)", "wait(s)")
+    order = ["phase", "api", "command"]
+    for (category, name), row in sorted(rows.items(), key=lambda x: order.index(x[0][0])):
+        logger.info("%-8s %-48s %7d %10.3f %10.3f %10.3f", category, name[:48], row["count"],
+                    row["total"], row["max"], row["wait"])
+
+
+def write_trace(logger, options):
+    """ write the spans recorded so far to the trace file """
+    trace = utils.GLOBALS["trace"]
+    with trace["lock"]:
+        spans = sorted(trace["spans"], key=lambda x: x["ts"])
+        names = [{"name":"thread_name", "ph":"M", "pid":os.getpid(), "tid":tid,
+                  "args":{"name":track}} for track, tid in trace["tids"].items()]
+    logger.info("Writing %s spans to trace file: %s", len(spans), options.trace)
+    try:
+        with open(options.trace, "w") as trace_file:
+            json.dump({"traceEvents":names + spans, "displayTimeUnit":"ms"}, trace_file)
+    except (IOError, OSError) as err:
+        # stdout is the command output...
+        logger.error("Unable to write trace file: %s", err)
+    summarise(logger, spans)
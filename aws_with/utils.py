@@ -17,6 +17,8 @@ specific language governing permissions and limitations
 under the License.
 """
 
+import os
+import json
 import itertools
 import logging
 
@@ -49,6 +51,43 @@ def generic_paginator(logger, paged_function, result_object, **kwargs):
     return full_results
 
 
+def get_cache_dir():
+    """ get (and create if needed) the private directory used for on-disk caches """
+    cache_dir = os.environ.get("AWS_WITH_CACHE_DIR",
+                               os.path.join(os.path.expanduser("~"), ".aws_with", "cache"))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    return cache_dir
+
+
+def read_cache_file(logger, name):
+    """ read a JSON cache file, a missing or unreadable cache is treated as empty """
+    path = os.path.join(get_cache_dir(), name)
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError) as err:
+        logger.debug("Unable to read cache file %s: %s", path, err)
+        return None
+
+
+def write_cache_file(logger, name, data):
+    """ atomically write a JSON cache file that only the current user can read """
+    path = os.path.join(get_cache_dir(), name)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    logger.debug("Writing cache file: %s", path)
+    try:
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                       "w") as cache_file:
+            json.dump(data, cache_file)
+        if hasattr(os, "replace"):
+            os.replace(temp_path, path)
+        else:
+            os.rename(temp_path, path)
+    except (IOError, OSError) as err:
+        logger.info("Unable to write cache file %s: %s", path, err)
+
+
 def setup_logging(options):
     """ set up logging... """
     logger = logging.getLogger("aws_with")
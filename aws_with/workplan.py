@@ -18,19 +18,21 @@ under the License.
 """
 
 import sys
-import os
-import threading
+import time
 import boto3
 import botocore
-import socket
 
-from . import regions, utils, organizations, commands
+from . import regions, utils, organizations, commands, credentials, executor, preload, api, \
+    history, trace, metrics
 
 def examine_regions(logger, options):
     """ for each region provided, use it as a regex to search for regions... """
-    logger.debug("Getting list of regions")
-    regions_list = regions.get_regions_list(logger)
-    if options.regions:
+    if options.regions and not any(map(regions.is_region_pattern, options.regions)):
+        logger.info("Set regions: %s", ", ".join(options.regions))
+
+    elif options.regions:
+        logger.debug("Getting list of regions")
+        regions_list = regions.get_regions_list(logger, options)
         matched_regions = map(lambda x: regions.get_regions_from_regex(logger, x, regions_list),
                               options.regions)
         options.regions = sorted(set(utils.flatten_list(matched_regions)))
@@ -57,7 +59,8 @@ def examine_accounts(logger, options, org_client):
         logger.debug("No accounts specified on command line, guessing...")
         try:
             # if we have any kind of AWS credentials set then this should work...
-            account_id = boto3.client("sts").get_caller_identity()["Account"]
+            sts_client = trace.trace_client(boto3.client("sts"))
+            account_id = sts_client.get_caller_identity()["Account"]
             options.accounts = [account_id]
         except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError):
             print("error: unable to work out existing account ID, "
@@ -70,21 +73,26 @@ def examine_accounts(logger, options, org_client):
     logger.debug("Checking if we need to traverse an Organization")
     if options.ous:
         logger.debug("Getting list of accounts from OUs")
-        mapped_list = map(lambda path: organizations.get_accounts_for_ou(logger, options,
-                                                                         org_client, path),
-                          options.ous)
-        options.accounts = utils.flatten_list(mapped_list)
+        if options.org_cache_ttl > 0 or options.refresh_org:
+            org_index = organizations.get_org_snapshot(logger, options, org_client)
+        else:
+            org_index = organizations.create_org_index(logger, org_client)
+        options.accounts = organizations.get_accounts_for_ous(logger, options, org_client,
+                                                              org_index, options.ous)
         if options.no_master:
-            master = org_client.describe_organization()["Organization"]["MasterAccountId"]
+            if "Organization" in org_index:
+                master = org_index["Organization"]["MasterAccountId"]
+            else:
+                master = org_client.describe_organization()["Organization"]["MasterAccountId"]
             logger.debug("Removing the master account (%s) from the list of accounts", master)
-            options.accounts = filter(lambda x: x["Id"] != master, options.accounts)
+            options.accounts = list(filter(lambda x: x["Id"] != master, options.accounts))
 
     logger.info("Set accounts: %s", options.accounts)
 
 
 def examine_command(logger, options):
     """ look at the command and guess if it is an AWS CLI built in command """
-    if not options.no_cli_guess and options.command:
+    if not options.no_cli_guess and options.command and not options.api:
         try:
             import awscli.clidriver
             logger.debug("Guessing if the supplied command is an AWS CLI command..")
@@ -104,37 +112,46 @@ def build_work_plan(logger, options, sts_client):
     logger.info("Starting analysis on work plan")
     commands_list = []
 
-    # iterate over accounts and regions...
-    for account in options.accounts:
-
-        logger.debug("Looking at account: %s", account)
-        account_id = account["Id"] if isinstance(account, dict) else account
+    account_ids = [account["Id"] if isinstance(account, dict) else account
+                   for account in options.accounts]
 
-        # work out if we need to call STS to assume a new role...
-        if options.role:
+    # work out if we need to call STS to assume a new role, do it for all accounts up front...
+    if options.role:
+        assumed_roles = credentials.assume_roles(logger, options, sts_client, account_ids)
 
-            # call STS to get credentials for the account and role...
-            try:
-                arn = "arn:aws:iam::{}:role/{}".format(account_id, options.role)
-                logger.debug("Calling STS to get temporary credentials for: %s", arn)
-                assumed_role = sts_client.assume_role(
-                    RoleArn=arn,
-                    RoleSessionName="{}@{}".format(os.environ["USER"], socket.gethostname()),
-                    ExternalId="{}@{}".format(os.environ["USER"], socket.gethostname())
-                )
-
-            except botocore.exceptions.BotoCoreError as be_bce:
+        # report the first failure in plan order...
+        for account_id, (_, be_err) in zip(account_ids, assumed_roles):
+            if be_err is not None:
                 print("error switching role ({}@{}): {}".format(options.role,
-                                                                account_id, be_bce.args))
+                                                                account_id, be_err.args))
                 sys.exit(1)
+        credentials.start_credential_manager(sts_client, account_ids, assumed_roles)
 
-            except botocore.exceptions.ClientError as be_ce:
-                print("error switching role ({}@{}): {}".format(options.role,
-                                                                account_id, be_ce.args))
-                sys.exit(1)
+    # work out which regions are enabled in each account so we can skip the others...
+    enabled_regions = [None] * len(account_ids)
+    if options.enabled_regions_only:
+        enabled_regions = regions.get_enabled_regions(
+            logger, options, account_ids,
+            [x[0] for x in assumed_roles] if options.role else [None] * len(account_ids))
+
+    # iterate over accounts and regions...
+    for index, account in enumerate(options.accounts):
+
+        logger.debug("Looking at account: %s", account)
+        account_id = account_ids[index]
+        if options.role:
+            assumed_role = assumed_roles[index][0]
 
         for region in options.regions:
             logger.debug("Looking at region: %s", region)
+            if enabled_regions[index] is not None and region != "<default>" and \
+                    region not in enabled_regions[index]:
+                logger.info("Skipping region %s, it is not enabled in account %s",
+                            region, account_id)
+                commands_list.append(create_skipped_command(options, account, account_id, region,
+                                                            "region is not enabled in account"))
+                continue
+
             cmd = {}
             cmd["command"] = options.command
             cmd["environment"] = {}
@@ -150,7 +167,7 @@ def build_work_plan(logger, options, sts_client):
                 session = boto3.session.Session(profile_name=options.profile)
                 env["AWS_ACCESS_KEY_ID"] = session.get_credentials().access_key
             if options.role:
-                env["AWS_ACCESS_KEY_ID"] = assumed_role["Credentials"]["AccessKeyId"]
+                env["AWS_ACCESS_KEY_ID"] = assumed_role["AccessKeyId"]
 
             logger.debug("Adding command to work plan: %s", cmd)
             cmd["options"] = options
@@ -159,33 +176,60 @@ def build_work_plan(logger, options, sts_client):
             if options.profile:
                 env["AWS_SECRET_ACCESS_KEY"] = session.get_credentials().secret_key
             if options.role:
-                env["AWS_SECRET_ACCESS_KEY"] = assumed_role["Credentials"]["SecretAccessKey"]
-                env["AWS_SESSION_TOKEN"] = assumed_role["Credentials"]["SessionToken"]
+                credentials.set_environment_credentials(env, assumed_role)
 
             commands_list.append(cmd)
 
     return commands_list
 
 
-def execute_work_plan(logger, options, commands_list):
-    """ run through commands_list and run various commands in the thread pool """
-    logger.info("Executing work plan across a thread pool of size: %s", options.threads)
-    utils.GLOBALS["main_thread_lock"] = threading.Lock()
-    utils.GLOBALS["thread_pool_lock"] = threading.BoundedSemaphore(options.threads)
-    utils.GLOBALS["thread_count"] = len(commands_list)
-    logger.debug("Locks created, task list size = %s", utils.GLOBALS["thread_count"])
-
-    # obtain the main thread lock...
-    logger.debug("Acquiring main thread lock")
-    utils.GLOBALS["main_thread_lock"].acquire()
-
-    for cmd in commands_list:
-        logger.debug("waiting for next thread to be available")
-        utils.GLOBALS["thread_pool_lock"].acquire()
-        logger.debug("thread is available, starting thread")
-        threading.Thread(target=commands.run_command, args=(logger, options, cmd, )).start()
-
-    # block on the main thread lock being released...
-    logger.debug("Blocking main thread, waiting on commands to finish")
-    utils.GLOBALS["main_thread_lock"].acquire()
-    logger.debug("Main thread lock released, working on output")
+def create_skipped_command(options, account, account_id, region, reason):
+    """ create a work plan entry for a target that won't be run, along with its output """
+    cmd = {"command":options.command, "environment":{}, "role":options.role,
+           "account_id":account_id, "account":account, "region":region,
+           "options":options, "skipped":reason}
+    cmd["output"] = {"account":account_id, "role":options.role, "region":region,
+                     "command":" ".join(options.command), "output":"", "skipped":reason}
+    if isinstance(account, dict):
+        cmd["output"]["path"] = account["Path"]
+    return cmd
+
+
+def execute_work_plan(logger, options, commands_list, on_done=None):
+    """ run through commands_list and run various commands in the thread pool,
+        on_done() is called with each command as soon as it is finished """
+    if on_done is not None:
+        for cmd in [x for x in commands_list if "skipped" in x]:
+            on_done(cmd)
+    metrics.count_targets("planned", len(commands_list))
+    metrics.count_targets("skipped", len([x for x in commands_list if "skipped" in x]))
+    commands_list = [x for x in commands_list if "skipped" not in x]
+    if options.longest_first:
+        commands_list, predicted = history.order_longest_first(logger, options, commands_list)
+    started = time.time()
+    utils.GLOBALS["deadline"] = started + options.deadline if options.deadline else None
+    if options.engine == "events":
+        from . import events
+        logger.info("Executing work plan with up to %s commands running at once", options.threads)
+        events.execute(logger, options, commands_list, on_done)
+    elif options.api:
+        logger.info("Calling %s across a thread pool of size: %s", options.api, options.threads)
+        api.start_clients(logger, options, commands_list)
+        executor.execute(logger, options, commands_list, api.run_command_unsafe, on_done)
+    elif options.preload_cli and options.command[0] == "aws" and \
+            preload.start_pool(logger, options):
+        logger.info("Executing work plan across a pool of AWS CLI workers of size: %s",
+                    options.threads)
+        try:
+            executor.execute(logger, options, commands_list, preload.run_command_unsafe,
+                             on_done)
+        finally:
+            preload.stop_pool()
+    else:
+        logger.info("Executing work plan across a thread pool of size: %s", options.threads)
+        executor.execute(logger, options, commands_list, commands.run_command_unsafe, on_done)
+    if options.longest_first:
+        logger.info("Run time: %.1fs predicted, %.1fs actual",
+                    predicted, time.time() - started)
+        history.record_durations(logger, options, commands_list)
+    logger.debug("All commands finished, working on output")
@@ -0,0 +1,405 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    end-to-end benchmarks of aws_with against a synthetic organization, with stand-ins for
+    the Organizations, STS and EC2 clients and a fast fake `aws` executable, e.g.
+
+        python benchmarks/e2e.py --accounts 10,100,1000 --threads 10,50 --save results.json
+
+    each scenario runs aws_with.main in a fresh process, and reports the wall time, the time
+    to the first byte of output, peak RSS and the time and API calls of each phase
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import collections
+
+# the phases of a run, as the functions main() calls them through...
+PHASES = ["examine_regions", "examine_accounts", "examine_command", "build_work_plan",
+          "execute_work_plan"]
+
+# the real APIs return pages of up to this many results...
+PAGE_SIZE = 20
+
+ROOT_ID = "r-bench"
+MASTER_ACCOUNT_ID = "100000000000"
+
+
+class Recorder(object):
+    """ keeps track of the current phase, how long each phase took and the API calls made """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = "main"
+        self.calls = collections.defaultdict(collections.Counter)
+        self.phase_times = collections.OrderedDict()
+        self.phase_ended = None
+
+    def call(self, service, operation, latency):
+        """ count an API call against the current phase, taking as long as a real one might """
+        with self.lock:
+            self.calls[self.phase]["{}.{}".format(service, operation)] += 1
+        if latency:
+            time.sleep(latency)
+
+    def wrap(self, module, name):
+        """ replace a function in a module with one that records it as a phase """
+        function = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            """ run the phase """
+            self.phase = name
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.phase_ended = time.time()
+                self.phase_times[name] = round(self.phase_ended - started, 4)
+                self.phase = "output"
+        setattr(module, name, wrapper)
+
+
+class Sink(object):
+    """ stands in for stdout, counting the output and noting when the first of it arrived """
+
+    def __init__(self):
+        self.size = 0
+        self.first_write = None
+
+    def write(self, text):
+        """ count some output """
+        if text and self.first_write is None:
+            self.first_write = time.time()
+        self.size += len(text)
+
+    def flush(self):
+        """ nothing to flush """
+
+
+def paged(items, token, key):
+    """ return a page of results the way the paged APIs do """
+    start = int(token or 0)
+    result = {key:items[start:start + PAGE_SIZE]}
+    if start + PAGE_SIZE < len(items):
+        result["NextToken"] = format(start + PAGE_SIZE)
+    return result
+
+
+class FakeEvents(object):
+    """ enough of botocore's event system for aws_with to hook into API calls """
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        """ call handler for events starting with event_name """
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        """ call the handlers for an event """
+        for prefix, handler in self.handlers:
+            if event_name == prefix or event_name.startswith(prefix + "."):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakeClient(object):
+    """ a stand-in client, with the botocore meta data aws_with looks at """
+
+    def __init__(self, recorder, latency, service):
+        self.recorder = recorder
+        self.latency = latency
+        self.service = service
+        self.meta = argparse.Namespace(region_name="us-east-1", events=FakeEvents())
+
+    def call(self, operation):
+        """ make a stand-in API call """
+        context = {}
+        event_name = "{}.{}".format(self.service, operation)
+        self.meta.events.emit("before-call." + event_name, context=context)
+        self.recorder.call(self.service, operation, self.latency)
+        self.meta.events.emit("after-call." + event_name, context=context,
+                              http_response=argparse.Namespace(status_code=200), parsed={})
+
+
+class FakeOrganizations(FakeClient):
+    """ an organization with the accounts shared out across OUs below the root """
+
+    def __init__(self, recorder, latency, ous, accounts):
+        FakeClient.__init__(self, recorder, latency, "organizations")
+        joined = datetime.datetime(2018, 1, 1)
+        self.ous = [{"Id":"ou-bench-{:04d}".format(x), "Name":"ou{:04d}".format(x)}
+                    for x in range(ous)]
+        self.accounts = collections.defaultdict(list)
+        for index in range(accounts):
+            parent = self.ous[index % ous]["Id"] if ous else ROOT_ID
+            self.accounts[parent].append({"Id":format(200000000000 + index),
+                                          "Name":"account{}".format(index),
+                                          "Status":"ACTIVE", "JoinedTimestamp":joined})
+
+    def list_roots(self, **_):
+        """ the one root """
+        self.call("ListRoots")
+        return {"Roots":[{"Id":ROOT_ID, "Name":"Root"}]}
+
+    def describe_organization(self, **_):
+        """ the organization """
+        self.call("DescribeOrganization")
+        return {"Organization":{"Id":"o-bench", "MasterAccountId":MASTER_ACCOUNT_ID}}
+
+    def list_organizational_units_for_parent(self, ParentId, NextToken=None, **_):
+        """ all of the OUs are below the root """
+        self.call("ListOrganizationalUnitsForParent")
+        return paged(self.ous if ParentId == ROOT_ID else [], NextToken, "OrganizationalUnits")
+
+    def list_accounts_for_parent(self, ParentId, NextToken=None, **_):
+        """ the accounts in an OU """
+        self.call("ListAccountsForParent")
+        return paged(self.accounts[ParentId], NextToken, "Accounts")
+
+
+class FakeSTS(FakeClient):
+    """ hands out credentials for any role in any account """
+
+    def __init__(self, recorder, latency):
+        FakeClient.__init__(self, recorder, latency, "sts")
+
+    def get_caller_identity(self, **_):
+        """ who we are """
+        self.call("GetCallerIdentity")
+        return {"Account":MASTER_ACCOUNT_ID, "UserId":"bench",
+                "Arn":"arn:aws:iam::{}:user/bench".format(MASTER_ACCOUNT_ID)}
+
+    def assume_role(self, RoleArn, **_):
+        """ credentials that last an hour """
+        self.call("AssumeRole")
+        account_id = RoleArn.split(":")[4]
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        return {"Credentials":{"AccessKeyId":"ASIA" + account_id,
+                               "SecretAccessKey":"secret", "SessionToken":"token",
+                               "Expiration":expiration}}
+
+
+class FakeEC2(FakeClient):
+    """ knows about the regions """
+
+    def __init__(self, recorder, latency, regions):
+        FakeClient.__init__(self, recorder, latency, "ec2")
+        self.regions = regions
+
+    def describe_regions(self, **_):
+        """ every region is enabled everywhere """
+        self.call("DescribeRegions")
+        return {"Regions":[{"RegionName":x, "Endpoint":"ec2.{}.example".format(x)}
+                           for x in self.regions]}
+
+
+def install_fakes(config, recorder):
+    """ make boto3 hand out the stand-in clients """
+    import boto3
+    import boto3.session
+
+    regions = ["bench-{}-1".format(x) for x in range(config["regions"])]
+    latency = config["api_latency"]
+    clients = {
+        "organizations":FakeOrganizations(recorder, latency, config["ous"], config["accounts"]),
+        "sts":FakeSTS(recorder, latency),
+        "ec2":FakeEC2(recorder, latency, regions),
+    }
+
+    class FakeSession(object):
+        """ a session that only knows about the stand-in clients """
+        region_name = regions[0]
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def client(self, service, *args, **kwargs):  # pylint: disable=unused-argument
+            """ the stand-in client for a service """
+            return clients[service]
+
+        def get_available_regions(self, service):  # pylint: disable=unused-argument
+            """ the bundled list of regions """
+            return list(regions)
+
+    boto3.client = lambda service, *args, **kwargs: clients[service]
+    boto3.session.Session = FakeSession
+    boto3.setup_default_session = lambda *args, **kwargs: None
+
+
+def create_fake_aws(directory, output_size):
+    """ write an `aws` that just prints a canned JSON document of about output_size bytes """
+    document = {"Reservations":[{"ReservationId":"r-{:08d}".format(x), "Instances":[]}
+                                for x in range(max(1, output_size // 50))]}
+    document_path = os.path.join(directory, "output.json")
+    with open(document_path, "w") as document_file:
+        json.dump(document, document_file, indent=4)
+    aws_path = os.path.join(directory, "aws")
+    with open(aws_path, "w") as aws_file:
+        aws_file.write("#!/bin/sh\nexec cat {}\n".format(document_path))
+    os.chmod(aws_path, 0o755)
+
+
+def get_peak_rss_mb():
+    """ the peak resident set size of this process """
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes...
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def run_scenario(config):
+    """ run aws_with once, in this process, and return the measurements """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from aws_with import main, workplan
+
+    recorder = Recorder()
+    install_fakes(config, recorder)
+    for name in PHASES:
+        recorder.wrap(workplan, name)
+
+    work_dir = tempfile.mkdtemp(prefix="aws_with-bench-")
+    create_fake_aws(work_dir, config["output_size"])
+    os.environ["PATH"] = work_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["AWS_WITH_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ.setdefault("USER", "bench")
+
+    sink = Sink()
+    sys.argv = ["aws_with", "-r", "bench", "-o", "/", "-R", ".*", "-t", format(config["threads"]),
+                "-f", config["format"]] + config["extra_args"] + \
+        ["aws", "ec2", "describe-instances"]
+    saved_stdout = sys.stdout
+    sys.stdout = sink
+    started = time.time()
+    try:
+        main.main()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = saved_stdout
+    finished = time.time()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    if recorder.phase == "output":
+        recorder.phase_times["output"] = round(finished - recorder.phase_ended, 4)
+
+    return {
+        "config":config,
+        "wall_time":round(finished - started, 4),
+        "time_to_first_result":None if sink.first_write is None else
+                               round(sink.first_write - started, 4),
+        "output_bytes":sink.size,
+        "peak_rss_mb":get_peak_rss_mb(),
+        "phase_times":recorder.phase_times,
+        "api_calls":dict((phase, dict(counts)) for phase, counts in recorder.calls.items()),
+    }
+
+
+def get_git_commit():
+    """ the commit being benchmarked, if it can be found """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_in_process(config):
+    """ run a scenario in a fresh python process so peak RSS isn't shared between them """
+    result = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--scenario",
+                                      json.dumps(config)])
+    return json.loads(result.decode("utf-8").splitlines()[-1])
+
+
+def int_list(value):
+    """ a comma separated list of numbers """
+    return [int(x) for x in value.split(",")]
+
+
+def parse_args():
+    """ process command line arguments """
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks of aws_with")
+    parser.add_argument("--accounts", type=int_list, default=[10, 100],
+                        help="Comma separated numbers of accounts (default 10,100)")
+    parser.add_argument("--ous", type=int, default=10,
+                        help="Number of OUs the accounts are shared out across (default 10)")
+    parser.add_argument("--regions", type=int_list, default=[4],
+                        help="Comma separated numbers of regions (default 4)")
+    parser.add_argument("--threads", type=int_list, default=[10, 50],
+                        help="Comma separated values for --threads (default 10,50)")
+    parser.add_argument("--api-latency", type=float, default=0.02,
+                        help="Seconds each stand-in API call takes (default 0.02)")
+    parser.add_argument("--output-size", type=int, default=2048,
+                        help="Approximate bytes of output from each command (default 2048)")
+    parser.add_argument("--format", default="json", choices=["json", "yaml", "text", "ndjson"],
+                        help="Output format for aws_with (default json)")
+    parser.add_argument("--extra", default="",
+                        help="Extra aws_with arguments for every scenario, e.g. '--engine events'")
+    parser.add_argument("--save", metavar="FILE",
+                        help="Save the results as JSON to FILE")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """ run every combination of accounts, regions and threads """
+    args = parse_args()
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    results = []
+    print("{:>8} {:>7} {:>7} {:>9} {:>9} {:>8} {:>9}".format(
+        "accounts", "regions", "threads", "wall(s)", "first(s)", "rss(MB)", "api calls"))
+    for accounts in args.accounts:
+        for regions in args.regions:
+            for threads in args.threads:
+                config = {"accounts":accounts, "ous":args.ous, "regions":regions,
+                          "threads":threads, "api_latency":args.api_latency,
+                          "output_size":args.output_size, "format":args.format,
+                          "extra_args":args.extra.split()}
+                result = run_in_process(config)
+                results.append(result)
+                print("{:>8} {:>7} {:>7} {:>9.3f} {:>9} {:>8.1f} {:>9}".format(
+                    accounts, regions, threads, result["wall_time"],
+                    "-" if result["time_to_first_result"] is None else
+                    "{:.3f}".format(result["time_to_first_result"]),
+                    result["peak_rss_mb"],
+                    sum(sum(x.values()) for x in result["api_calls"].values())))
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump({"created":datetime.datetime.utcnow().isoformat(),
+                       "commit":get_git_commit(), "python":platform.python_version(),
+                       "platform":platform.platform(), "results":results},
+                      results_file, indent=4, sort_keys=True)
+        print("Results saved to: {}".format(args.save))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    microbenchmarks of gathering and formatting command outputs, which only run when
+    AWS_WITH_BENCHMARKS is set:
+
+        AWS_WITH_BENCHMARKS=1 python -m pytest tests/benchmarks
+
+    each case is timed relative to a fixed reference workload, so that the results can be
+    compared across machines, and its peak allocations are measured with tracemalloc; a case
+    fails if either is more than AWS_WITH_BENCHMARK_THRESHOLD (default 0.3, i.e. 30%) worse
+    than in baseline.json, set AWS_WITH_BENCHMARK_SAVE=1 to record a new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from aws_with import output, capture  # pylint: disable=wrong-import-position
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+THRESHOLD = float(os.environ.get("AWS_WITH_BENCHMARK_THRESHOLD", "0.3"))
+
+# each case is run this many times and the fastest run is used...
+ROUNDS = int(os.environ.get("AWS_WITH_BENCHMARK_ROUNDS", "3"))
+
+pytestmark = pytest.mark.skipif(not os.environ.get("AWS_WITH_BENCHMARKS"),
+                                reason="set AWS_WITH_BENCHMARKS=1 to run the benchmarks")
+
+
+def describe_instances(count):
+    """ a describe-instances style document with count instances """
+    return {"Reservations":[{
+        "ReservationId":"r-{:017x}".format(index),
+        "OwnerId":"123456789012",
+        "Instances":[{
+            "InstanceId":"i-{:017x}".format(index),
+            "InstanceType":"m5.large",
+            "ImageId":"ami-0123456789abcdef0",
+            "LaunchTime":"2018-01-01T00:00:00.000Z",
+            "PrivateIpAddress":"10.0.{}.{}".format(index // 256 % 256, index % 256),
+            "State":{"Code":16, "Name":"running"},
+            "SecurityGroups":[{"GroupId":"sg-0123456789abcdef0", "GroupName":"default"}],
+            "Tags":[{"Key":"Name", "Value":"instance-{}".format(index)},
+                    {"Key":"Environment", "Value":"benchmark"}],
+        }],
+    } for index in range(count)]}
+
+
+# name: (command, output from each command, number of commands)
+INPUTS = {
+    "empty":(["aws", "ec2", "describe-instances"],
+             json.dumps({"Reservations":[]}, indent=4) + "\n", 2000),
+    "large":(["aws", "ec2", "describe-instances"],
+             json.dumps(describe_instances(3000), indent=4) + "\n", 1),
+    "text":(["uptime"],
+            "".join(" 12:00:00 up {} days,  3 users,  load average: 0.00, 0.01, 0.05\n"
+                    .format(x) for x in range(40)), 500),
+}
+
+# name: (input, format, --quiet, --no-passthrough)
+CASES = {
+    "empty-json":("empty", "json", False, False),
+    "empty-json-quiet":("empty", "json", True, False),
+    "empty-yaml":("empty", "yaml", False, False),
+    "empty-text":("empty", "text", False, False),
+    "large-json":("large", "json", False, False),
+    "large-json-parsed":("large", "json", False, True),
+    "large-json-quiet":("large", "json", True, False),
+    "large-yaml":("large", "yaml", False, False),
+    "large-text":("large", "text", False, False),
+    "text-json":("text", "json", False, False),
+    "text-yaml":("text", "yaml", False, False),
+    "text-text":("text", "text", False, False),
+}
+
+
+class Sink(object):
+    """ stands in for stdout, only counting what is written """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        """ count some output """
+        self.size += len(text)
+
+    def flush(self):
+        """ nothing to flush """
+
+
+def create_commands(name):
+    """ a list of finished commands, as execute_work_plan() leaves them """
+    command, text, count = INPUTS[name]
+    commands_list = []
+    for index in range(count):
+        buffer = capture.Buffer()
+        buffer.write(text.encode("utf-8"))
+        commands_list.append({"command":command, "output":{
+            "account":format(100000000000 + index), "role":"benchmark",
+            "region":"us-east-1", "command":" ".join(command), "output":buffer.finish()}})
+    return commands_list
+
+
+def run_pipeline(options, commands_list):
+    """ gather, filter and format the outputs, as main() does """
+    logger = logging.getLogger("aws_with.benchmarks")
+    outputs = output.gather_command_outputs(logger, options, commands_list)
+    output.write_outputs(logger, options, outputs, Sink())
+
+
+def reference_workload(document):
+    """ a fixed amount of work that the time of each case is measured against """
+    json.loads(json.dumps(document, indent=4))
+
+
+def time_it(function, setup):
+    """ the fastest of ROUNDS runs of function(setup()), with setup() not timed """
+    fastest = None
+    for _ in range(ROUNDS):
+        argument = setup()
+        started = time.time()
+        function(argument)
+        elapsed = time.time() - started
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return fastest
+
+
+def measure(case):
+    """ time a case relative to the reference workload, and measure its peak allocations """
+    input_name, output_format, quiet, no_passthrough = CASES[case]
+    options = argparse.Namespace(format=output_format, quiet=quiet,
+                                 no_passthrough=no_passthrough)
+    size = len(INPUTS[input_name][1]) * INPUTS[input_name][2]
+
+    reference = time_it(reference_workload, lambda: describe_instances(500))
+    elapsed = time_it(lambda x: run_pipeline(options, x), lambda: create_commands(input_name))
+
+    commands_list = create_commands(input_name)
+    tracemalloc.start()
+    try:
+        run_pipeline(options, commands_list)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"relative_time":round(elapsed / reference, 3),
+            "throughput_mb_s":round(size / elapsed / 1024 / 1024, 2),
+            "peak_alloc":peak}
+
+
+def load_baseline():
+    """ the stored results to compare against """
+    try:
+        with open(BASELINE_FILE) as baseline_file:
+            return json.load(baseline_file)
+    except (IOError, OSError, ValueError):
+        return {"cases":{}}
+
+
+def save_baseline(case, result):
+    """ record a case's results as the new baseline """
+    baseline = load_baseline()
+    baseline["python"] = "{}.{}".format(*sys.version_info[:2])
+    baseline["cases"][case] = result
+    with open(BASELINE_FILE, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write("\n")
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_output_pipeline(case):
+    """ fail if the case is slower, or allocates more, than the baseline allows """
+    result = measure(case)
+    print("{}: {}".format(case, result))
+    if os.environ.get("AWS_WITH_BENCHMARK_SAVE"):
+        save_baseline(case, result)
+        return
+
+    baseline = load_baseline()
+    if case not in baseline["cases"]:
+        pytest.skip("no baseline for {}, set AWS_WITH_BENCHMARK_SAVE=1 to record one".format(case))
+    expected = baseline["cases"][case]
+
+    assert result["relative_time"] <= expected["relative_time"] * (1 + THRESHOLD), \
+        "{} took {}x the reference workload, the baseline is {}x".format(
+            case, result["relative_time"], expected["relative_time"])
+
+    # allocations depend on the python version more than anything else...
+    if baseline.get("python") == "{}.{}".format(*sys.version_info[:2]):
+        assert result["peak_alloc"] <= expected["peak_alloc"] * (1 + THRESHOLD), \
+            "{} allocated up to {} bytes, the baseline is {} bytes".format(
+                case, result["peak_alloc"], expected["peak_alloc"])
@@ -0,0 +1,121 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    tests of how the WorkQueue shared by both engines hands out commands, without running
+    any of them
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+import pytest
+
+pytest.importorskip("botocore")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws_with import utils, executor  # pylint: disable=wrong-import-position
+
+
+def create_options(**kwargs):
+    """ the options the WorkQueue looks at """
+    options = argparse.Namespace(threads=4, max_per_region=None, max_per_account=None,
+                                 max_per_target=None, adaptive=False, retries=0,
+                                 stop_on_error=False, timeout=None, hedge=False,
+                                 hedge_percentile=95.0, hedge_limit=0.1)
+    for key, value in kwargs.items():
+        setattr(options, key, value)
+    return options
+
+
+def create_command(account_id, region):
+    """ a command as build_work_plan() creates it """
+    return {"command":["aws", "sts", "get-caller-identity"], "environment":{}, "role":None,
+            "account":account_id, "account_id":account_id, "region":region, "options":None}
+
+
+def create_queue(options, commands_list):
+    """ a WorkQueue in a fresh run """
+    utils.GLOBALS["stop_because_of_error"] = False
+    utils.GLOBALS["deadline_reached"] = False
+    return executor.WorkQueue(logging.getLogger("aws_with.tests"), options, commands_list)
+
+
+def make_straggler(work_queue, cmd, samples=executor.HEDGE_MIN_SAMPLES):
+    """ pretend enough commands have finished quickly, and cmd has been running for ages """
+    work_queue.durations.extend([0.1] * samples)
+    cmd["attempt_started"] -= 60
+
+
+def test_limits():
+    """ a command isn't handed out while its region is at its limit """
+    commands_list = [create_command("111111111111", "eu-west-1"),
+                     create_command("222222222222", "eu-west-1"),
+                     create_command("333333333333", "us-east-1")]
+    work_queue = create_queue(create_options(max_per_region=1), commands_list)
+    first = work_queue.get(False)
+    assert first is commands_list[0]
+    assert work_queue.get(False) is commands_list[2]
+    assert work_queue.get(False) is None
+    with work_queue.condition:
+        work_queue.stop(first)
+    assert work_queue.get(False) is commands_list[1]
+
+
+def test_hedge():
+    """ a command that runs for much longer than the others gets a second attempt """
+    commands_list = [create_command("111111111111", "eu-west-1")]
+    work_queue = create_queue(create_options(hedge=True, hedge_limit=0.25), commands_list)
+    original = work_queue.get(False)
+    assert work_queue.get(False) is None
+    make_straggler(work_queue, original)
+    assert work_queue.next_ready_in() == 0
+    hedge = work_queue.get(False)
+    assert hedge["hedge_pair"] is original["hedge_pair"]
+    assert hedge["command"] == original["command"]
+    assert work_queue.next_ready_in() is None
+
+
+def test_hedge_needs_samples():
+    """ nothing is hedged until enough commands have finished to know what slow is """
+    commands_list = [create_command("111111111111", "eu-west-1")]
+    work_queue = create_queue(create_options(hedge=True, hedge_limit=0.25), commands_list)
+    make_straggler(work_queue, work_queue.get(False), executor.HEDGE_MIN_SAMPLES - 1)
+    assert work_queue.get(False) is None
+    assert work_queue.next_ready_in() is None
+
+
+def test_hedge_limit_is_a_fraction_of_threads():
+    """ --hedge-limit is rounded down, so it can allow no hedges at all """
+    commands_list = [create_command("111111111111", "eu-west-1")]
+    work_queue = create_queue(create_options(threads=2, hedge=True), commands_list)
+    make_straggler(work_queue, work_queue.get(False))
+    assert work_queue.get(False) is None
+    assert work_queue.next_ready_in() is None
+
+
+def test_unrunnable_hedge_is_not_waited_for():
+    """ a straggler that can't be hedged because of the limits doesn't keep waking the
+        workers up """
+    commands_list = [create_command("111111111111", "eu-west-1")]
+    options = create_options(hedge=True, hedge_limit=0.25, max_per_target=1)
+    work_queue = create_queue(options, commands_list)
+    make_straggler(work_queue, work_queue.get(False))
+    assert work_queue.get(False) is None
+    assert work_queue.next_ready_in() is None
@@ -0,0 +1,109 @@
+"""
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+
+    tests that API calls made with a real botocore client are counted, failed ones included,
+    with the endpoint stubbed out so that nothing is sent to AWS
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+import pytest
+
+botocore_session = pytest.importorskip("botocore.session")
+config = pytest.importorskip("botocore.config")
+awsrequest = pytest.importorskip("botocore.awsrequest")
+exceptions = pytest.importorskip("botocore.exceptions")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws_with import utils, metrics, trace  # pylint: disable=wrong-import-position
+
+IDENTITY = b"""<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <GetCallerIdentityResult>
+    <Arn>arn:aws:iam::111111111111:user/test</Arn>
+    <UserId>AIDATEST</UserId>
+    <Account>111111111111</Account>
+  </GetCallerIdentityResult>
+  <ResponseMetadata><RequestId>1</RequestId></ResponseMetadata>
+</GetCallerIdentityResponse>"""
+
+THROTTLED = b"""<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error>
+    <Type>Sender</Type>
+    <Code>Throttling</Code>
+    <Message>Rate exceeded</Message>
+  </Error>
+  <RequestId>2</RequestId>
+</ErrorResponse>"""
+
+
+class StubbedEndpoint(object):
+    """ answers requests with the responses given, instead of sending them """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def __call__(self, request, **_):
+        status_code, body = self.responses.pop(0)
+        raw = argparse.Namespace(stream=lambda **_: iter([body]))
+        return awsrequest.AWSResponse(request.url, status_code, {}, raw)
+
+
+def create_client(responses):
+    """ a real STS client that doesn't retry """
+    session = botocore_session.get_session()
+    client = session.create_client(
+        "sts", region_name="us-east-1", aws_access_key_id="AKIATEST",
+        aws_secret_access_key="secret",
+        config=config.Config(retries={"max_attempts":0}))
+    client.meta.events.register("before-send", StubbedEndpoint(responses))
+    return trace.trace_client(client)
+
+
+@pytest.fixture(name="options")
+def fixture_options(tmp_path, monkeypatch):
+    """ keep metrics for the test only """
+    options = argparse.Namespace(metrics_file=str(tmp_path / "aws_with.prom"),
+                                 metrics_interval=0)
+    monkeypatch.setattr(metrics.atexit, "register", lambda *_: None)
+    monkeypatch.setitem(utils.GLOBALS, "metrics", None)
+    metrics.start_metrics(logging.getLogger("aws_with.tests"), options)
+    return options
+
+
+def test_api_errors(options):
+    """ a throttled call arrives as after-call with an error response, not as after-call-error,
+        and is still counted as an error """
+    client = create_client([(200, IDENTITY), (400, THROTTLED)])
+    assert client.get_caller_identity()["Account"] == "111111111111"
+    with pytest.raises(exceptions.ClientError):
+        client.get_caller_identity()
+
+    counted = utils.GLOBALS["metrics"]
+    assert counted["api_calls"][("sts", "GetCallerIdentity")] == 2
+    assert counted["api_errors"][("sts", "GetCallerIdentity")] == 1
+    assert counted["throttling"]["api"] == 1
+
+    metrics.write_metrics(logging.getLogger("aws_with.tests"), options)
+    with open(options.metrics_file) as metrics_file:
+        text = metrics_file.read()
+    assert ('aws_with_api_errors{operation="GetCallerIdentity",service="sts"} 1'
+            in text.splitlines())
+    assert 'aws_with_throttling_events{source="api"} 1' in text.splitlines()